@@ -1,13 +1,53 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
 import boto3
 from boto3.dynamodb.conditions import Key
-from datetime import datetime
-from typing import Optional
+from botocore.config import Config
+from collections import OrderedDict, deque, namedtuple
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from email.utils import format_datetime, parsedate_to_datetime
+from pydantic import BaseModel
+from typing import List, Optional
+import numpy as np
+import asyncio
+import base64
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+
+# errors in background tasks have no request to fail, so they are logged with tracebacks
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app):
+   # warm-up and the ingest poller run in the background so /health can answer meanwhile
+   poller = asyncio.create_task(poll_cache_versions())
+   yield
+   poller.cancel()
 
 # create the api app
-app =FastAPI (title="Renewable Energy Data API", version="1.0.0")
+app =FastAPI (title="Renewable Energy Data API", version="1.0.0", lifespan=lifespan)
 
 # allow requests for browser access
 app.add_middleware (
@@ -18,9 +58,1117 @@ app.add_middleware (
    allow_headers=["*"],
 )
 
+# arrow / parquet responses are only offered when pyarrow is installed
+try:
+   import pyarrow as pa
+   import pyarrow.parquet as pq
+except ImportError:
+   pa = None
+
+# brotli is offered to clients that accept it when the module is installed
+try:
+   import brotli
+except ImportError:
+   brotli = None
+
+# the cross-worker cache needs posix file locks for its writers
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+
+# one pooled connection per threadpool worker, botocore only keeps 10 by default and
+# every call past that opens (and then throws away) a fresh tls connection
+DYNAMODB_POOL_CONNECTIONS = 40
+
 # connect to aws dynamodb
-dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
+dynamodb = boto3.resource('dynamodb', region_name='us-east-1', config=Config(max_pool_connections=DYNAMODB_POOL_CONNECTIONS))
 table_name ='energy-data-analytics-energy-data'
+# counters written by the lambda on every ingest
+stats_table_name = 'energy-data-analytics-energy-stats'
+
+# table handles by name. boto3 builds a new resource class on every dynamodb.Table()
+# call (about 1 ms), so each handle is built once and shared. clear this after
+# swapping out dynamodb
+_tables = {}
+
+def get_table(name):
+   table = _tables.get(name)
+   if table is None:
+       table = _tables.setdefault(name, dynamodb.Table(name))
+   return table
+
+# latency buckets in seconds, size buckets in bytes
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+class Histogram:
+   # fixed buckets, so an observation is a bisect plus three adds under a tiny lock
+   # (botocore hooks record from threadpool threads, routes from the event loop)
+   def __init__(self, buckets):
+       self.buckets = buckets
+       self.counts = [0] * (len(buckets) + 1)
+       self.sum = 0.0
+       self.count = 0
+       self._lock = threading.Lock()
+
+   def observe(self, value):
+       index = bisect.bisect_left(self.buckets, value)
+       with self._lock:
+           self.counts[index] += 1
+           self.sum += value
+           self.count += 1
+
+   def snapshot(self):
+       with self._lock:
+           return list(self.counts), self.sum, self.count
+
+class MetricFamily:
+   # one metric name with a child per label set. children are created once and
+   # then looked up without taking the lock
+   def __init__(self, name, help_text, kind, labels, buckets=None):
+       self.name = name
+       self.help_text = help_text
+       self.kind = kind
+       self.labels = labels
+       self.buckets = buckets
+       self._children = {}
+       self._lock = threading.Lock()
+
+   def child(self, *label_values):
+       child = self._children.get(label_values)
+       if child is None:
+           with self._lock:
+               child = self._children.setdefault(label_values, Histogram(self.buckets) if self.kind == "histogram" else [0.0])
+       return child
+
+   def observe(self, value, *label_values):
+       self.child(*label_values).observe(value)
+
+   def inc(self, *label_values, amount=1):
+       # a lost increment under a race is acceptable for a counter, a lock per call is not
+       self.child(*label_values)[0] += amount
+
+   def render(self):
+       lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+       for label_values, child in sorted(self._children.items()):
+           labels = ",".join(f'{name}="{prometheus_escape(value)}"' for name, value in zip(self.labels, label_values))
+           if self.kind != "histogram":
+               lines.append(f"{self.name}{{{labels}}} {child[0]}")
+               continue
+           counts, total, count = child.snapshot()
+           prefix = labels + "," if labels else ""
+           cumulative = 0
+           for bound, bucket_count in zip(self.buckets + ["+Inf"], counts):
+               cumulative += bucket_count
+               lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+           lines.append(f"{self.name}_sum{{{labels}}} {total}")
+           lines.append(f"{self.name}_count{{{labels}}} {count}")
+       return "\n".join(lines)
+
+def prometheus_escape(value):
+   return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+request_latency = MetricFamily("energy_api_request_duration_seconds", "Time spent handling requests, including streaming the body.", "histogram", ["method", "route", "status"], LATENCY_BUCKETS)
+response_size = MetricFamily("energy_api_response_size_bytes", "Response body size.", "histogram", ["method", "route"], SIZE_BUCKETS)
+dynamodb_calls = MetricFamily("energy_api_dynamodb_calls_total", "DynamoDB API calls.", "counter", ["operation", "outcome"])
+dynamodb_latency = MetricFamily("energy_api_dynamodb_call_duration_seconds", "DynamoDB API call latency.", "histogram", ["operation"], LATENCY_BUCKETS)
+dynamodb_capacity = MetricFamily("energy_api_dynamodb_consumed_capacity_total", "Capacity units consumed by DynamoDB calls.", "counter", ["operation", "table"])
+compression_bytes = MetricFamily("energy_api_compression_bytes_total", "Response body bytes before and after compression.", "counter", ["encoding", "stage"])
+metric_families = [request_latency, response_size, dynamodb_calls, dynamodb_latency, dynamodb_capacity, compression_bytes]
+
+class MetricsMiddleware:
+   # plain asgi middleware so streaming responses keep streaming -- latency is measured
+   # until the last body chunk is sent and size is the sum of the chunks
+   def __init__(self, app):
+       self.app = app
+
+   async def __call__(self, scope, receive, send):
+       if scope["type"] != "http":
+           await self.app(scope, receive, send)
+           return
+       start = time.perf_counter()
+       status = [500]
+       size = [0]
+
+       async def send_wrapper(message):
+           if message["type"] == "http.response.start":
+               status[0] = message["status"]
+           elif message["type"] == "http.response.body":
+               size[0] += len(message.get("body", b""))
+           await send(message)
+
+       try:
+           await self.app(scope, receive, send_wrapper)
+       finally:
+           # the router puts the matched route in the scope, use its template so ids don't blow up the label set
+           route = scope.get("route")
+           path = route.path if route is not None else "unmatched"
+           request_latency.observe(time.perf_counter() - start, scope["method"], path, str(status[0]))
+           response_size.observe(size[0], scope["method"], path)
+
+# whole responses smaller than this go out as they are, compressing them costs more than it saves
+COMPRESSION_MIN_BYTES = 1024
+# per encoding level, see benchmarks/compression.py for bytes vs cpu at each level
+COMPRESSION_LEVELS = {"br": 4, "gzip": 6, "deflate": 6}
+# bigger bodies are compressed in the threadpool (zlib and brotli release the gil) so
+# one large response doesn't stall the event loop
+COMPRESSION_THREAD_BYTES = 256 * 1024
+# preferred order when a client accepts several encodings equally
+COMPRESSION_PREFERENCE = ["br", "gzip", "deflate"]
+# already compressed, or events that must reach the client without waiting in a compressor
+COMPRESSION_SKIP_TYPES = ("application/vnd.apache.parquet", "text/event-stream", "application/gzip", "image/")
+
+def negotiate_encoding(accept_encoding):
+   # best encoding we support from an Accept-Encoding header, None for identity
+   offered = {}
+   for part in accept_encoding.split(","):
+       name, _, params = part.strip().partition(";")
+       quality = 1.0
+       for param in params.split(";"):
+           key, _, value = param.strip().partition("=")
+           if key == "q":
+               try:
+                   quality = float(value)
+               except ValueError:
+                   quality = 0.0
+       offered[name.strip().lower()] = quality
+   best = None
+   for encoding in COMPRESSION_PREFERENCE:
+       if encoding == "br" and brotli is None:
+           continue
+       quality = offered.get(encoding, offered.get("*", 0.0))
+       if quality > 0 and (best is None or quality > best[1]):
+           best = (encoding, quality)
+   return best and best[0]
+
+class StreamCompressor:
+   # incremental compressor. every chunk but the last is flushed, so whatever was passed
+   # in can be decoded by the client right away and streaming keeps working
+   def __init__(self, encoding, level):
+       self.encoding = encoding
+       if encoding == "br":
+           self._compressor = brotli.Compressor(quality=level)
+       else:
+           # gzip framing for gzip, zlib framing for http "deflate"
+           self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+
+   async def compress_async(self, data, final=False):
+       if len(data) >= COMPRESSION_THREAD_BYTES:
+           return await run_in_threadpool(self.compress, data, final)
+       return self.compress(data, final)
+
+   def compress(self, data, final=False):
+       if self.encoding == "br":
+           out = self._compressor.process(data)
+           return out + (self._compressor.finish() if final else self._compressor.flush())
+       out = self._compressor.compress(data)
+       return out + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class CompressionMiddleware:
+   # plain asgi middleware like MetricsMiddleware. the first body message decides: a whole
+   # response is compressed in one go above COMPRESSION_MIN_BYTES, a streaming one chunk
+   # by chunk as it is sent
+   def __init__(self, app, min_bytes=COMPRESSION_MIN_BYTES, levels=COMPRESSION_LEVELS):
+       self.app = app
+       self.min_bytes = min_bytes
+       self.levels = levels
+
+   async def __call__(self, scope, receive, send):
+       if scope["type"] != "http" or scope["method"] == "HEAD":
+           await self.app(scope, receive, send)
+           return
+       accept = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"accept-encoding"), "")
+       encoding = negotiate_encoding(accept)
+       start = None
+       compressor = None
+       passthrough = False
+
+       async def send_wrapper(message):
+           nonlocal start, compressor, passthrough
+           if message["type"] == "http.response.start":
+               start = message
+               return
+           if message["type"] != "http.response.body" or passthrough:
+               await send(message)
+               return
+           body = message.get("body", b"")
+           more = message.get("more_body", False)
+           if compressor is None:
+               headers = MutableHeaders(scope=start)
+               content_type = headers.get("content-type", "")
+               if start["status"] in (204, 304) or "content-encoding" in headers or content_type.startswith(COMPRESSION_SKIP_TYPES):
+                   passthrough = True
+                   await send(start)
+                   await send(message)
+                   return
+               headers.add_vary_header("Accept-Encoding")
+               if encoding is None or (not more and len(body) < self.min_bytes):
+                   passthrough = True
+                   await send(start)
+                   await send(message)
+                   return
+               compressor = StreamCompressor(encoding, self.levels[encoding])
+               headers["Content-Encoding"] = encoding
+               if more:
+                   del headers["Content-Length"]
+               else:
+                   body = await compressor.compress_async(body, final=True)
+                   headers["Content-Length"] = str(len(body))
+                   compression_bytes.inc(encoding, "identity", amount=len(message.get("body", b"")))
+                   compression_bytes.inc(encoding, "encoded", amount=len(body))
+                   await send(start)
+                   await send({"type": "http.response.body", "body": body})
+                   return
+               await send(start)
+           compressed = await compressor.compress_async(body, final=not more)
+           compression_bytes.inc(encoding, "identity", amount=len(body))
+           compression_bytes.inc(encoding, "encoded", amount=len(compressed))
+           await send({"type": "http.response.body", "body": compressed, "more_body": more})
+
+       await self.app(scope, receive, send_wrapper)
+
+# added first so it sits inside the metrics middleware, which then sees bytes on the wire
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+def request_consumed_capacity(params, model, **kwargs):
+   # ask dynamodb to report what every call cost
+   if 'ReturnConsumedCapacity' in model.input_shape.members:
+       params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+def start_dynamodb_timer(model, context, **kwargs):
+   # after-call-error only gets the context, so keep the operation there too
+   context['metrics_operation'] = model.name
+   context['metrics_started_at'] = time.perf_counter()
+
+def record_dynamodb_call(context, parsed=None, http_response=None, exception=None, **kwargs):
+   operation = context.get('metrics_operation', 'unknown')
+   started_at = context.get('metrics_started_at')
+   if started_at is not None:
+       dynamodb_latency.observe(time.perf_counter() - started_at, operation)
+   failed = exception is not None or (http_response is not None and http_response.status_code >= 300)
+   dynamodb_calls.inc(operation, "error" if failed else "ok")
+   consumed = (parsed or {}).get('ConsumedCapacity')
+   # batch operations return a list, everything else a single entry
+   for entry in consumed if isinstance(consumed, list) else [consumed] if consumed else []:
+       dynamodb_capacity.inc(operation, entry.get('TableName', ''), amount=float(entry.get('CapacityUnits', 0)))
+
+# every call made through the shared client goes through these hooks
+dynamodb_events = dynamodb.meta.client.meta.events
+dynamodb_events.register('before-parameter-build.dynamodb', request_consumed_capacity)
+dynamodb_events.register('before-call.dynamodb', start_dynamodb_timer)
+dynamodb_events.register('after-call.dynamodb', record_dynamodb_call)
+dynamodb_events.register('after-call-error.dynamodb', record_dynamodb_call)
+
+# new data lands every 5 minutes, so a short ttl is plenty
+CACHE_TTL_SECONDS = 60
+CACHE_MAX_ENTRIES = 512
+# how often we look for new ingest versions
+CACHE_VERSION_POLL_SECONDS = 15
+# set to a file on tmpfs (e.g. /dev/shm/energy-api-cache) to share cached responses
+# between `uvicorn --workers N` processes on one host
+SHARED_CACHE_PATH = os.environ.get("ENERGY_API_SHARED_CACHE")
+# 512 slots x 64 KiB = 32 MiB, responses bigger than a slot stay per worker
+SHARED_CACHE_SLOTS = 512
+SHARED_CACHE_SLOT_BYTES = 64 * 1024
+
+def decimal_to_number(obj):
+   # dynamodb numbers come back as decimals. integers are converted exactly, counters
+   # past 2**53 would lose digits through float
+   if type(obj) is Decimal:
+       if obj == obj.to_integral_value():
+           return int(obj)
+       return float(obj)
+   raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# shared c encoder, items from boto3 are plain dicts/lists so no circular check needed
+dynamo_json_encoder = json.JSONEncoder(
+   default=decimal_to_number,
+   ensure_ascii=False,
+   check_circular=False,
+   allow_nan=False,
+   separators=(",", ":")
+)
+
+class DynamoJSONResponse(JSONResponse):
+   # renders dynamodb items straight to json bytes. routes return this directly
+   # so fastapi skips the recursive jsonable_encoder walk over every item
+   def render(self, content):
+       return dynamo_json_encoder.encode(content).encode("utf-8")
+
+class SharedCache:
+   # fixed-size table of slots in a memory-mapped file, shared by every worker on the host.
+   # a key can live in one of two slots. each slot is a seqlock: writers take a posix lock
+   # on the slot and make the sequence odd while they write, readers take no lock and
+   # retry nothing -- a slot that changed under them or fails its crc is just a miss.
+   # entries are tagged with the ingest version they were computed from, which every
+   # worker polls from the same stats table, so a worker never serves an entry from
+   # another ingest than the one it has seen
+   MAGIC = b"ENRGCCH1"
+   HEADER = struct.Struct("<8sII")
+   # sequence, key hash, expires at (wall clock), version tag, key length, value length, crc32
+   SLOT = struct.Struct("<QQdQIII")
+   SEQUENCE = struct.Struct("<Q")
+
+   def __init__(self, path, slots=SHARED_CACHE_SLOTS, slot_bytes=SHARED_CACHE_SLOT_BYTES):
+       self.path = path
+       self.slots = slots
+       self.slot_bytes = slot_bytes
+       self.size = self.HEADER.size + slots * slot_bytes
+       self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+       # the first worker to start lays the file out, the others wait for it
+       fcntl.flock(self._fd, fcntl.LOCK_EX)
+       try:
+           header = os.pread(self._fd, self.HEADER.size, 0)
+           if os.fstat(self._fd).st_size != self.size or header != self.HEADER.pack(self.MAGIC, slots, slot_bytes):
+               os.ftruncate(self._fd, 0)
+               os.ftruncate(self._fd, self.size)
+               os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, slots, slot_bytes), 0)
+       finally:
+           fcntl.flock(self._fd, fcntl.LOCK_UN)
+       self._map = mmap.mmap(self._fd, self.size)
+       self.hits = 0
+       self.misses = 0
+       self.writes = 0
+       self.oversize = 0
+       self.busy = 0
+
+   def _candidates(self, key_hash):
+       return (key_hash % self.slots, (key_hash >> 32) % self.slots)
+
+   def _offset(self, index):
+       return self.HEADER.size + index * self.slot_bytes
+
+   def _read(self, index, key_hash, key, tag):
+       offset = self._offset(index)
+       sequence, slot_hash, expires_at, slot_tag, key_length, value_length, crc = self.SLOT.unpack_from(self._map, offset)
+       if sequence & 1 or slot_hash != key_hash or slot_tag != tag or expires_at <= time.time():
+           return None
+       start = offset + self.SLOT.size
+       data = self._map[start:start + key_length + value_length]
+       if self.SEQUENCE.unpack_from(self._map, offset)[0] != sequence:
+           return None
+       if data[:key_length] != key or zlib.crc32(data) != crc:
+           return None
+       return data[key_length:], expires_at
+
+   def get(self, key, tag):
+       # (value bytes, expires at) or None, without taking any lock
+       key_hash = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+       for index in self._candidates(key_hash):
+           entry = self._read(index, key_hash, key, tag)
+           if entry is not None:
+               self.hits += 1
+               return entry
+       self.misses += 1
+       return None
+
+   def put(self, key, value, tag, expires_at):
+       if self.SLOT.size + len(key) + len(value) > self.slot_bytes:
+           self.oversize += 1
+           return
+       key_hash = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+       # same key or an expired slot first, otherwise the one expiring sooner
+       now = time.time()
+       choices = []
+       for index in self._candidates(key_hash):
+           _, slot_hash, slot_expires_at, *_ = self.SLOT.unpack_from(self._map, self._offset(index))
+           choices.append((slot_hash != key_hash, slot_expires_at > now, slot_expires_at, index))
+       index = min(choices)[3]
+       offset = self._offset(index)
+       data = key + value
+       # posix locks are per process and writes only happen on the event loop thread.
+       # a slot another worker is writing right now is skipped rather than waited for
+       try:
+           fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, self.slot_bytes, offset)
+       except OSError:
+           self.busy += 1
+           return
+       try:
+           sequence = self.SEQUENCE.unpack_from(self._map, offset)[0] | 1
+           self.SEQUENCE.pack_into(self._map, offset, sequence)
+           self._map[offset + self.SLOT.size:offset + self.SLOT.size + len(data)] = data
+           self.SLOT.pack_into(self._map, offset, sequence, key_hash, expires_at, tag, len(key), len(value), zlib.crc32(data))
+           self.SEQUENCE.pack_into(self._map, offset, sequence + 1)
+       finally:
+           fcntl.lockf(self._fd, fcntl.LOCK_UN, self.slot_bytes, offset)
+       self.writes += 1
+
+   def stats(self):
+       lookups = self.hits + self.misses
+       return {
+           "path": self.path,
+           "slots": self.slots,
+           "slot_bytes": self.slot_bytes,
+           "hits": self.hits,
+           "misses": self.misses,
+           "writes": self.writes,
+           "oversize": self.oversize,
+           "busy": self.busy,
+           "hit_rate": (self.hits / lookups) if lookups > 0 else 0,
+       }
+
+class ResponseCache:
+   # bounded in-memory cache for route responses with ttl + lru eviction
+   # entries are tagged with a site (or the whole fleet) and dropped early
+   # when ingest bumps that site's version
+
+   def __init__(self, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS, shared=None):
+       self.max_entries = max_entries
+       self.ttl = ttl
+       # optional SharedCache consulted on a local miss before loading
+       self.shared = shared
+       # key -> (expires_at, scope, version, value)
+       self._entries = OrderedDict()
+       # key -> future shared by everyone waiting on the same miss
+       self._inflight = {}
+       self._site_versions = {}
+       self._fleet_version = 0
+       self.hits = 0
+       self.misses = 0
+       self.coalesced = 0
+       self.shared_hits = 0
+       self.evictions = 0
+       self.invalidations = 0
+
+   @staticmethod
+   def make_key(route, params):
+       # same params in any order (or left out) give the same key
+       normalized = tuple(sorted((k, str(v)) for k, v in params.items() if v is not None))
+       return (route, normalized)
+
+   def version(self, scope):
+       # scope None means the entry depends on every site
+       if scope is None:
+           return self._fleet_version
+       return self._site_versions.get(scope, 0)
+
+   def bump_site_version(self, site_id):
+       # called when a site gets new data -- its entries and fleet wide ones go stale
+       self._site_versions[site_id] = self._site_versions.get(site_id, 0) + 1
+       self._fleet_version += 1
+       self.invalidations += 1
+
+   def get(self, key):
+       entry = self._entries.get(key)
+       if entry is None:
+           return None
+       expires_at, scope, version, value = entry
+       if expires_at <= time.monotonic() or version != self.version(scope):
+           del self._entries[key]
+           return None
+       self._entries.move_to_end(key)
+       return value
+
+   def put(self, key, value, scope, version, ttl=None):
+       self._entries[key] = (time.monotonic() + (ttl or self.ttl), scope, version, value)
+       self._entries.move_to_end(key)
+       while len(self._entries) > self.max_entries:
+           self._entries.popitem(last=False)
+           self.evictions += 1
+
+   async def get_or_load(self, route, params, loader, scope=None, ttl=None):
+       # return a cached value or run the loader once for all concurrent callers. blocking
+       # loaders run in the threadpool, coroutine functions are awaited
+       key = self.make_key(route, params)
+       value = self.get(key)
+       if value is not None:
+           self.hits += 1
+           return value
+
+       pending = self._inflight.get(key)
+       if pending is not None:
+           self.coalesced += 1
+           try:
+               return await asyncio.shield(pending)
+           except asyncio.CancelledError:
+               # the caller running the loader was cancelled, not us: load it again
+               if not pending.cancelled():
+                   raise
+               return await self.get_or_load(route, params, loader, scope, ttl)
+
+       version = self.version(scope)
+       tag = shared_version_tag(scope) if self.shared is not None else None
+       if tag is not None:
+           entry = self.shared.get(repr((key, scope)).encode(), tag)
+           if entry is not None:
+               # another worker already loaded it for the same ingest
+               value = json.loads(entry[0], parse_float=Decimal)
+               self.shared_hits += 1
+               self.put(key, value, scope, version, max(entry[1] - time.time(), 0.001))
+               return value
+
+       self.misses += 1
+       future = asyncio.get_running_loop().create_future()
+       self._inflight[key] = future
+       try:
+           if asyncio.iscoroutinefunction(loader):
+               value = await loader()
+           else:
+               value = await run_in_threadpool(loader)
+       except Exception as e:
+           future.set_exception(e)
+           # nobody else may be waiting, don't let asyncio warn about it
+           future.exception()
+           raise
+       except BaseException:
+           # cancelled (client gone, feed stopped), so waiters must not hang on the future
+           future.cancel()
+           raise
+       finally:
+           del self._inflight[key]
+       # only keep it if no ingest happened while we were loading
+       if version == self.version(scope):
+           self.put(key, value, scope, version, ttl)
+           if tag is not None and tag == shared_version_tag(scope):
+               self.share(key, value, scope, tag, ttl)
+       future.set_result(value)
+       return value
+
+   def share(self, key, value, scope, tag, ttl=None):
+       # stored as json, the same thing the response would render to
+       try:
+           data = dynamo_json_encoder.encode(value).encode("utf-8")
+       except (TypeError, ValueError):
+           return
+       self.shared.put(repr((key, scope)).encode(), data, tag, time.time() + (ttl or self.ttl))
+
+   def stats(self):
+       lookups = self.hits + self.misses + self.coalesced + self.shared_hits
+       return {
+           "entries": len(self._entries),
+           "max_entries": self.max_entries,
+           "ttl_seconds": self.ttl,
+           "hits": self.hits,
+           "misses": self.misses,
+           "coalesced": self.coalesced,
+           "shared_hits": self.shared_hits,
+           "evictions": self.evictions,
+           "invalidations": self.invalidations,
+           "hit_rate": ((self.hits + self.coalesced + self.shared_hits) / lookups) if lookups > 0 else 0,
+           "site_versions": dict(self._site_versions),
+           "shared": self.shared.stats() if self.shared is not None else None,
+       }
+
+def shared_version_tag(scope):
+   # the ingest version a shared entry depends on, as seen by this worker. it comes from
+   # the stats table, so it means the same thing in every worker (unlike the local
+   # counters). None until the first poll, and nothing is shared then
+   if _ingest_state is None:
+       return None
+   if scope is None:
+       # versions only go up, so the sum changes whenever any site is ingested
+       return sum(version for version, _ in _ingest_state.values())
+   return _ingest_state.get(scope, (0, None))[0]
+
+response_cache = ResponseCache(shared=SharedCache(SHARED_CACHE_PATH) if SHARED_CACHE_PATH and fcntl is not None else None)
+# last ingest (version, last_ingest_at) seen per site in the stats table, None until the first poll
+_ingest_state = None
+# when that state was last refreshed successfully
+_ingest_polled_at = 0.0
+# coverage markers of the aggregates, refreshed with the versions
+_aggregate_coverage = {}
+
+def load_ingest_versions():
+   # one query returns the ingest counter for every site
+   stats_table = get_table(stats_table_name)
+   response = stats_table.query(KeyConditionExpression=Key('pk').eq('site_versions'))
+   return {item['sk']: (int(item['version']), item.get('last_ingest_at')) for item in response['Items']}
+
+def load_aggregate_coverage():
+   # how far back the lambda-maintained rollups, anomaly index and totals go
+   response = get_table(stats_table_name).get_item(Key={'pk': 'meta', 'sk': 'coverage'})
+   return response.get('Item', {})
+
+async def refresh_cache_versions():
+   # bump local versions for any site the lambda has written to since last poll
+   global _ingest_state, _ingest_polled_at, _aggregate_coverage
+   state = await run_in_threadpool(load_ingest_versions)
+   _aggregate_coverage = await run_in_threadpool(load_aggregate_coverage)
+   # rings catch up first, so nothing recomputed after the bump reads an old ring
+   await hot_readings.refresh(state)
+   if _ingest_state is not None:
+       for site_id, (version, _) in state.items():
+           if site_id not in _ingest_state or _ingest_state[site_id][0] != version:
+               response_cache.bump_site_version(site_id)
+   _ingest_state = state
+   _ingest_polled_at = time.monotonic()
+
+# connections opened before the api reports ready, enough for a burst of first requests
+WARMUP_CONNECTIONS = 8
+# set once warm-up has finished, /health reports 503 until then
+_ready_at = None
+_warmup_seconds = None
+_warmup_error = None
+
+def warm_connection():
+   # a miss on the stats table costs half a read unit and leaves an open connection in the pool
+   get_table(stats_table_name).get_item(Key={'pk': 'meta', 'sk': 'warmup'})
+
+async def warm_up():
+   # pay the cold costs before traffic does: resource classes, credentials, endpoint
+   # resolution and tls handshakes, then the ingest state and hot rings
+   global _ready_at, _warmup_seconds, _warmup_error
+   started = time.perf_counter()
+   try:
+       get_table(table_name)
+       # the first call resolves credentials, the rest then connect in parallel
+       await run_in_threadpool(warm_connection)
+       await asyncio.gather(*[run_in_threadpool(warm_connection) for _ in range(WARMUP_CONNECTIONS - 1)])
+       await refresh_cache_versions()
+   except Exception as e:
+       _warmup_error = str(e)
+       raise
+   _warmup_seconds = time.perf_counter() - started
+   _warmup_error = None
+   _ready_at = datetime.utcnow()
+
+async def poll_cache_versions():
+   while True:
+       try:
+           if _ready_at is None:
+               await warm_up()
+           else:
+               await refresh_cache_versions()
+       except Exception as e:
+           logger.exception(f"Error polling ingest versions: {str(e)}")
+       await asyncio.sleep(CACHE_VERSION_POLL_SECONDS)
+
+# query planner: routes ask for a plan, which picks the cheapest source that fully covers
+# the request and is reported back in the X-Query-Plan debug header
+QUERY_PLAN_HEADER = "X-Query-Plan"
+# the data generator sends 1-3 readings per site every 5 minutes
+READINGS_PER_SITE_HOUR = 24
+# share of readings that get flagged, only used for estimates
+ANOMALY_RATE_ESTIMATE = 0.05
+# sparse index over the anomaly_at attribute the lambda sets on anomalies
+ANOMALY_INDEX_NAME = 'site-anomalies-index'
+# items the last scan / totals query read, the estimate for the next one
+_last_reads = {"scan": None, "totals": None}
+
+QueryPlan = namedtuple("QueryPlan", ["source", "estimated_reads", "reason", "detail"], defaults=[None])
+
+def totals_cost_class(request):
+   # reading the totals is a single query, only a scan needs the scan slots
+   return "query" if plan_totals().source == "totals" else "scan"
+
+def describe_plan(plan, cached=False):
+   if cached:
+       return f"source=cache; estimated_reads=0; reason=cached {plan.source} result"
+   reads = "unknown" if plan.estimated_reads is None else plan.estimated_reads
+   return f"source={plan.source}; estimated_reads={reads}; reason={plan.reason}"
+
+def hours_between(start, end):
+   return max(0.0, (end - start).total_seconds() / 3600)
+
+def floor_hour(moment):
+   return moment.replace(minute=0, second=0, microsecond=0)
+
+def ceil_hour(moment):
+   hour = floor_hour(moment)
+   return hour if hour == moment else hour + timedelta(hours=1)
+
+def plan_site_data(site_id, start_time, end_time, limit):
+   # callers want the readings themselves, only raw items (or their copy in memory) have them
+   if hot_readings.covers(site_id, start_time, end_time, limit):
+       return QueryPlan("hot", 0, "recent readings in memory")
+   if start_time and end_time:
+       expected = int(hours_between(parse_timestamp(start_time), parse_timestamp(end_time)) * READINGS_PER_SITE_HOUR)
+       return QueryPlan("raw", min(limit, expected), "raw readings requested")
+   return QueryPlan("raw", limit, "raw readings requested")
+
+def plan_series(site_id, start_time, end_time, resolution, mode):
+   # ranges the hot readings hold need no reads at all. otherwise whole hours can come
+   # from the hourly rollups when every bucket is made of whole hours and the rollups
+   # cover them, the partial hours at either end stay raw
+   if hot_readings.covers(site_id, start_time, end_time):
+       return QueryPlan("hot", 0, "recent range in memory")
+   start = parse_timestamp(start_time)
+   end = parse_timestamp(end_time)
+   raw_reads = int(hours_between(start, end) * READINGS_PER_SITE_HOUR)
+   if mode != "aggregate":
+       return QueryPlan("raw", raw_reads, "lttb needs every reading")
+   if resolution % 3600:
+       return QueryPlan("raw", raw_reads, "resolution finer than rollups")
+   since = _aggregate_coverage.get('rollups_since')
+   if not since:
+       return QueryPlan("raw", raw_reads, "no rollup coverage")
+
+   # the hour holding the first aggregated reading may be partial, start after it
+   first_hour = max(ceil_hour(start), floor_hour(parse_timestamp(since)) + timedelta(hours=1))
+   end_hour = floor_hour(end)
+   if end_hour <= first_hour:
+       return QueryPlan("raw", raw_reads, "range not covered by rollups")
+   edge_hours = hours_between(start, first_hour) + hours_between(end_hour, end)
+   rollup_reads = int(hours_between(first_hour, end_hour) + edge_hours * READINGS_PER_SITE_HOUR)
+   if rollup_reads >= raw_reads:
+       return QueryPlan("raw", raw_reads, "short range")
+   return QueryPlan("rollup_1h+raw", rollup_reads, "whole hours from rollups", (first_hour, end_hour))
+
+def plan_anomalies(limit):
+   since = _aggregate_coverage.get('anomalies_since')
+   if since:
+       return QueryPlan("anomaly_index", limit, "sparse anomaly index", since)
+   return QueryPlan("raw", int(limit / ANOMALY_RATE_ESTIMATE), "no anomaly index coverage")
+
+def plan_fleet_anomalies(start_time, end_time, sites, limit):
+   # one page of anomalies across sites. the day index reads about one item per anomaly
+   # returned, the per-site index up to a page per site, raw readings everything in range
+   if sites:
+       since = _aggregate_coverage.get('anomalies_since')
+       if since and start_time >= since:
+           return QueryPlan("anomaly_index", len(sites) * (limit + 1), "per-site anomaly index", since)
+   else:
+       since = _aggregate_coverage.get('anomaly_days_since')
+       if since and start_time >= since:
+           return QueryPlan("anomaly_day_index", limit + 1, "anomaly index by day", since)
+   site_count = len(sites) if sites else len(_ingest_state or {})
+   hours = hours_between(parse_timestamp(start_time), parse_timestamp(end_time))
+   reads = int(hours * READINGS_PER_SITE_HOUR * site_count) if site_count else None
+   return QueryPlan("raw", reads, "no anomaly index coverage for the range")
+
+def plan_totals():
+   # summary and site list, from the per-site totals once a backfill made them complete
+   if _aggregate_coverage.get('totals_complete'):
+       return QueryPlan("totals", _last_reads["totals"], "per-site totals")
+   return QueryPlan("scan", _last_reads["scan"], "totals incomplete")
+
+# hot readings: the newest readings of each site kept in memory so the common "last few
+# hours" requests never reach dynamodb. about 1 KB per reading, so 1024 x 100 sites ~ 100 MB
+HOT_CAPACITY = 1024
+HOT_MAX_SITES = 100
+# late readings inside this window are still merged in on refresh
+HOT_OVERLAP = timedelta(minutes=10)
+
+class RecentReadings:
+   # fixed-size ring of one site's newest readings. slots are overwritten oldest first,
+   # so appends never allocate and the readings stay in timestamp order
+   def __init__(self, capacity=HOT_CAPACITY):
+       self.capacity = capacity
+       self._items = [None] * capacity
+       self._head = 0
+       self.size = 0
+       # true while the ring holds every reading the site has
+       self.complete = False
+       # ingest version the ring was last brought up to, None until loaded
+       self.version = None
+       self.lock = threading.Lock()
+
+   def _at(self, i):
+       return self._items[(self._head + i) % self.capacity]
+
+   def _push(self, item):
+       if self.size < self.capacity:
+           self._items[(self._head + self.size) % self.capacity] = item
+           self.size += 1
+       else:
+           self._items[self._head] = item
+           self._head = (self._head + 1) % self.capacity
+           self.complete = False
+
+   def _bisect(self, timestamp, right=False):
+       # first position whose timestamp is >= (or > with right) the given one
+       lo, hi = 0, self.size
+       while lo < hi:
+           mid = (lo + hi) // 2
+           current = self._at(mid)['timestamp']
+           if current < timestamp or (right and current == timestamp):
+               lo = mid + 1
+           else:
+               hi = mid
+       return lo
+
+   def newest(self):
+       return self._at(self.size - 1)['timestamp'] if self.size else None
+
+   def _fill(self, items, complete):
+       self._items = [None] * self.capacity
+       self._head = 0
+       self.size = 0
+       for item in items[-self.capacity:]:
+           self._push(item)
+       self.complete = complete and len(items) <= self.capacity
+
+   def reset(self, items, complete):
+       # items oldest first, only the newest `capacity` are kept
+       with self.lock:
+           self._fill(items, complete)
+
+   def merge(self, items):
+       # items oldest first from an overlapping watermark query. new ones are appended,
+       # late ones that belong inside the window force a rebuild
+       with self.lock:
+           newest = self.newest()
+           oldest = self._at(0)['timestamp'] if self.size else None
+           late = [
+               item for item in items
+               if newest is not None and item['timestamp'] <= newest
+               and (self.complete or item['timestamp'] >= oldest)
+               and self._at(min(self._bisect(item['timestamp']), self.size - 1))['timestamp'] != item['timestamp']
+           ]
+           if late:
+               merged = sorted([self._at(i) for i in range(self.size)] + late, key=lambda item: item['timestamp'])
+               self._fill(merged, self.complete)
+           for item in items:
+               if newest is None or item['timestamp'] > newest:
+                   self._push(item)
+
+   def select(self, start_time=None, end_time=None, limit=None):
+       # readings in [start_time, end_time] oldest first, the newest `limit` of them when
+       # given. None when the ring can't be sure it has all of them
+       with self.lock:
+           lo = self._bisect(start_time) if start_time else 0
+           hi = self._bisect(end_time, right=True) if end_time else self.size
+           if limit is not None:
+               lo = max(lo, hi - limit)
+           covered = (
+               self.complete or lo > 0
+               or (limit is not None and hi - lo >= limit)
+               or (start_time is not None and self.size and start_time >= self._at(0)['timestamp'])
+           )
+           if not covered:
+               return None
+           return [self._at(i) for i in range(lo, hi)]
+
+class HotReadings:
+   # one ring per site, brought up to date by the ingest version poller
+   def __init__(self, capacity=HOT_CAPACITY, max_sites=HOT_MAX_SITES):
+       self.capacity = capacity
+       self.max_sites = max_sites
+       self.rings = {}
+       self.hits = 0
+       self.misses = 0
+       self.refreshes = 0
+
+   def track(self, site_id):
+       # sites seen in requests are loaded on the next poll
+       if site_id not in self.rings and len(self.rings) < self.max_sites:
+           self.rings[site_id] = RecentReadings(self.capacity)
+
+   def ring(self, site_id):
+       # a ring is only used while it matches the ingest version we last polled
+       if _ingest_state is None or time.monotonic() - _ingest_polled_at > 2 * CACHE_VERSION_POLL_SECONDS:
+           return None
+       ring = self.rings.get(site_id)
+       if ring is None:
+           self.track(site_id)
+           return None
+       if ring.version != _ingest_state.get(site_id, (0, None))[0]:
+           return None
+       return ring
+
+   def select(self, site_id, start_time=None, end_time=None, limit=None):
+       ring = self.ring(site_id)
+       items = ring.select(start_time, end_time, limit) if ring is not None else None
+       if items is None:
+           self.misses += 1
+       else:
+           self.hits += 1
+       return items
+
+   def covers(self, site_id, start_time=None, end_time=None, limit=None):
+       ring = self.ring(site_id)
+       return ring is not None and ring.select(start_time, end_time, limit) is not None
+
+   def load(self, site_id, ring, version):
+       newest = ring.newest()
+       if newest is None:
+           # newest readings first, then flip them into ring order
+           table = get_table(table_name)
+           kwargs = {"KeyConditionExpression": Key('site_id').eq(site_id), "ScanIndexForward": False, "Limit": self.capacity}
+           items = []
+           while len(items) < self.capacity:
+               response = table.query(**kwargs)
+               items.extend(response['Items'])
+               if 'LastEvaluatedKey' not in response:
+                   break
+               kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+               kwargs['Limit'] = self.capacity - len(items)
+           ring.reset(items[::-1], complete=len(items) < self.capacity)
+       else:
+           since = (parse_timestamp(newest) - HOT_OVERLAP).isoformat() + 'Z'
+           ring.merge(query_readings_since(site_id, since))
+       ring.version = version
+       self.refreshes += 1
+
+   async def refresh(self, state):
+       # bring every ring whose site was ingested since its last refresh up to date
+       for site_id in state:
+           self.track(site_id)
+       stale = [(site_id, ring, state.get(site_id, (0, None))[0]) for site_id, ring in list(self.rings.items())]
+       stale = [entry for entry in stale if entry[1].version != entry[2]]
+       semaphore = asyncio.Semaphore(FLEET_QUERY_CONCURRENCY)
+
+       async def load(site_id, ring, version):
+           async with semaphore:
+               try:
+                   await run_in_threadpool(self.load, site_id, ring, version)
+               except Exception as e:
+                   # stays on the old version, so it isn't served and gets retried next poll
+                   logger.exception(f"Error refreshing hot readings for {site_id}: {str(e)}")
+
+       await asyncio.gather(*[load(*entry) for entry in stale])
+
+   def stats(self):
+       lookups = self.hits + self.misses
+       return {
+           "sites": len(self.rings),
+           "capacity": self.capacity,
+           "readings": sum(ring.size for ring in self.rings.values()),
+           "hits": self.hits,
+           "misses": self.misses,
+           "refreshes": self.refreshes,
+           "hit_rate": (self.hits / lookups) if lookups > 0 else 0,
+       }
+
+hot_readings = HotReadings()
+
+# clients and proxies may reuse a response for as long as we go between version polls
+HTTP_MAX_AGE_SECONDS = CACHE_VERSION_POLL_SECONDS
+
+def validators(route, params, scope=None):
+   # weak etag + last-modified from the ingest counters of the sites a response depends on.
+   # only trusted while the last poll is recent, otherwise the caller does a normal read
+   if _ingest_state is None or time.monotonic() - _ingest_polled_at > 2 * CACHE_VERSION_POLL_SECONDS:
+       return None
+   if scope is None:
+       sites = sorted(_ingest_state)
+   elif isinstance(scope, str):
+       sites = [scope]
+   else:
+       sites = sorted(scope)
+   state = [(site_id,) + _ingest_state.get(site_id, (0, None)) for site_id in sites]
+   digest = hashlib.sha1(repr((ResponseCache.make_key(route, params), state)).encode()).hexdigest()[:20]
+   headers = {"ETag": f'W/"{digest}"', "Cache-Control": f"public, max-age={HTTP_MAX_AGE_SECONDS}"}
+   ingested = [last_ingest_at for _, _, last_ingest_at in state if last_ingest_at]
+   if ingested:
+       last_modified = datetime.fromisoformat(max(ingested)).replace(microsecond=0, tzinfo=timezone.utc)
+       headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+   return headers
+
+def not_modified(request, headers):
+   # If-None-Match wins over If-Modified-Since when both are sent
+   if_none_match = request.headers.get("if-none-match")
+   if if_none_match is not None:
+       etag = headers["ETag"].removeprefix("W/")
+       tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+       return "*" in tags or etag in tags
+   if_modified_since = request.headers.get("if-modified-since")
+   if if_modified_since is not None and "Last-Modified" in headers:
+       try:
+           return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(headers["Last-Modified"])
+       except (TypeError, ValueError):
+           return False
+   return False
+
+async def cached_json(request, route, params, loader, scope=None, plan=None, sliding=False):
+   # conditional get in front of the response cache: a matching validator answers
+   # 304 without touching dynamodb or the cache
+   headers = validators(route, params, scope)
+   if headers is not None and sliding:
+       # a default window moves with the clock, the data watermark alone can't say it is
+       # unchanged. the etag has the window bounds in it, so only that validates
+       headers.pop("Last-Modified", None)
+   if headers is not None and not_modified(request, headers):
+       return Response(status_code=304, headers=headers)
+   if plan is not None:
+       key = ResponseCache.make_key(route, params)
+       cached = response_cache.get(key) is not None or key in response_cache._inflight
+       headers = dict(headers or {})
+       headers[QUERY_PLAN_HEADER] = describe_plan(plan, cached)
+   result = await response_cache.get_or_load(route, params, loader, scope=scope)
+   return DynamoJSONResponse(result, headers=headers)
+
+# admission control: cost class -> (max concurrent, max queued, max wait seconds, retry-after seconds).
+# routes pick a class, so a burst of full scans can't starve cheap key lookups
+ADMISSION_CLASSES = {
+   "scan": (2, 8, 10.0, 5),
+   "fanout": (4, 16, 5.0, 2),
+   "query": (32, 128, 2.0, 1),
+   "stream": (200, 0, 0.0, 10),
+}
+
+class AdmissionLimiter:
+   # concurrency limit with a bounded fifo wait queue. when the queue is full, or a
+   # request waits too long, it is shed with a 503 instead of piling up
+   def __init__(self, name, max_concurrent, max_queue, max_wait, retry_after):
+       self.name = name
+       self.max_concurrent = max_concurrent
+       self.max_queue = max_queue
+       self.max_wait = max_wait
+       self.retry_after = retry_after
+       self.active = 0
+       self._waiters = deque()
+       self.admitted = 0
+       self.shed = 0
+
+   def _overloaded(self):
+       self.shed += 1
+       return HTTPException(
+           status_code=503,
+           detail=f"Server busy ({self.name} requests), try again later",
+           headers={"Retry-After": str(self.retry_after)}
+       )
+
+   async def acquire(self):
+       if self.active < self.max_concurrent and not self._waiters:
+           self.active += 1
+           self.admitted += 1
+           return
+       if len(self._waiters) >= self.max_queue:
+           raise self._overloaded()
+
+       waiter = asyncio.get_running_loop().create_future()
+       self._waiters.append(waiter)
+       try:
+           await asyncio.wait_for(waiter, self.max_wait)
+       except asyncio.TimeoutError:
+           raise self._overloaded()
+       except asyncio.CancelledError:
+           # client left right after being handed a slot -- pass it on
+           if waiter.done() and not waiter.cancelled():
+               self.release()
+           raise
+       finally:
+           if waiter in self._waiters:
+               self._waiters.remove(waiter)
+       self.admitted += 1
+
+   def release(self):
+       # hand the slot straight to the oldest waiter that is still waiting
+       while self._waiters:
+           waiter = self._waiters.popleft()
+           if not waiter.done():
+               waiter.set_result(None)
+               return
+       self.active -= 1
+
+   def stats(self):
+       return {
+           "active": self.active,
+           "queued": len(self._waiters),
+           "max_concurrent": self.max_concurrent,
+           "max_queue": self.max_queue,
+           "admitted": self.admitted,
+           "shed": self.shed,
+       }
+
+admission_limiters = {name: AdmissionLimiter(name, *limits) for name, limits in ADMISSION_CLASSES.items()}
+
+def admission(cost_class):
+   # route dependency holding a slot of the cost class until the response is sent. the
+   # class can also be a function of the request, for routes whose cost depends on the
+   # query plan or parameters
+   async def admit(request: Request):
+       limiter = admission_limiters[cost_class(request) if callable(cost_class) else cost_class]
+       await limiter.acquire()
+       try:
+           yield
+       finally:
+           limiter.release()
+
+   return admit
 
 @app.get("/")
 async def root():
@@ -29,119 +1177,1799 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-   # check if api is working
-   return {"status": "healthy", "timestamp" : datetime.utcnow().isoformat()}
+   # ready only after warm-up, so load balancers hold traffic until first requests are fast
+   if _ready_at is None:
+       body = {"status": "starting", "ready": False, "error": _warmup_error, "timestamp": datetime.utcnow().isoformat()}
+       return JSONResponse(body, status_code=503)
+   return {
+       "status": "healthy",
+       "ready": True,
+       "ready_at": _ready_at.isoformat(),
+       "warmup_seconds": round(_warmup_seconds, 3),
+       "timestamp" : datetime.utcnow().isoformat()
+   }
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+   # hit/miss counters for the response cache
+   return response_cache.stats()
+
+@app.get("/hot/stats")
+async def get_hot_stats():
+   # sites, readings held and hit/miss counters for the hot readings
+   return hot_readings.stats()
+
+def runtime_metrics():
+   # response cache, hot readings, live feed and admission counters in prometheus form
+   stats = response_cache.stats()
+   lines = []
+   for name, kind, value in (
+       ("hits", "counter", stats["hits"]),
+       ("misses", "counter", stats["misses"]),
+       ("coalesced", "counter", stats["coalesced"]),
+       ("shared_hits", "counter", stats["shared_hits"]),
+       ("evictions", "counter", stats["evictions"]),
+       ("invalidations", "counter", stats["invalidations"]),
+       ("entries", "gauge", stats["entries"]),
+       ("hit_ratio", "gauge", stats["hit_rate"]),
+   ):
+       suffix = "_total" if kind == "counter" else ""
+       lines.append(f"# TYPE energy_api_cache_{name}{suffix} {kind}")
+       lines.append(f"energy_api_cache_{name}{suffix} {value}")
+   hot = hot_readings.stats()
+   for name, kind, value in (("hits", "counter", hot["hits"]), ("misses", "counter", hot["misses"]), ("readings", "gauge", hot["readings"])):
+       suffix = "_total" if kind == "counter" else ""
+       lines.append(f"# TYPE energy_api_hot_{name}{suffix} {kind}")
+       lines.append(f"energy_api_hot_{name}{suffix} {value}")
+   feed = change_feed.stats()
+   lines.append("# TYPE energy_api_stream_subscribers gauge")
+   lines.append(f"energy_api_stream_subscribers {feed['subscribers']}")
+   lines.append("# TYPE energy_api_stream_dropped_total counter")
+   lines.append(f"energy_api_stream_dropped_total {feed['dropped']}")
+   for name, kind, key in (("active", "gauge", "active"), ("queue_depth", "gauge", "queued"), ("shed_total", "counter", "shed")):
+       lines.append(f"# TYPE energy_api_admission_{name} {kind}")
+       for cost_class, limiter in admission_limiters.items():
+           lines.append(f'energy_api_admission_{name}{{cost_class="{cost_class}"}} {limiter.stats()[key]}')
+   return lines
+
+@app.get("/admission/stats")
+async def get_admission_stats():
+   # in flight, queued and shed requests per cost class
+   return {name: limiter.stats() for name, limiter in admission_limiters.items()}
+
+@app.get("/metrics")
+async def get_metrics():
+   # prometheus text exposition
+   sections = [family.render() for family in metric_families]
+   sections.append("\n".join(runtime_metrics()))
+   return Response("\n".join(sections) + "\n", media_type="text/plain; version=0.0.4")
 
-@app.get ("/sites/{site_id}/data")
+# attributes the lambda writes for every reading
+READING_FIELDS = ['site_id', 'timestamp', 'energy_generated_kwh', 'energy_consumed_kwh', 'net_energy_kwh', 'anomaly', 'processed_at']
+
+def parse_fields(fields):
+   # "timestamp,net_energy_kwh" -> list of known attributes, None means everything
+   if not fields:
+       return None
+   selected = []
+   for field in fields.split(','):
+       field = field.strip()
+       if field not in READING_FIELDS:
+           raise HTTPException(status_code=400, detail=f"Unknown field: {field}")
+       if field not in selected:
+           selected.append(field)
+   return selected
+
+def projection(fields):
+   # timestamp is a reserved word in dynamodb, so every field goes through a name placeholder
+   names = {f"#f{i}": field for i, field in enumerate(fields)}
+   return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+def project_items(items, fields):
+   # what a ProjectionExpression would have returned, for items served from memory
+   if not fields:
+       return items
+   return [{field: item[field] for field in fields if field in item} for item in items]
+
+def to_columns(items, fields):
+   # parallel arrays instead of one object per row, keys are only written once
+   fields = fields or [field for field in READING_FIELDS if any(field in item for item in items)]
+   return {field: [item.get(field) for item in items] for field in fields}
+
+def shape_items(result, key, items, fields, layout):
+   if layout == "columns":
+       result["columns"] = to_columns(items, fields)
+   else:
+       result[key] = items
+   return result
+
+def site_data_key(site_id, start_time, end_time):
+   key_condition =Key('site_id').eq(site_id)
+
+   # add time filters
+   if start_time and end_time:
+       key_condition =key_condition & Key('timestamp').between(start_time, end_time)
+   elif start_time:
+       key_condition = key_condition & Key('timestamp').gte(start_time)
+   elif end_time:
+       key_condition =key_condition & Key('timestamp').lte(end_time)
+   return key_condition
+
+def iter_site_data_pages(site_id, start_time, end_time, limit, plan, fields=None):
+   # the newest `limit` readings in the range, page by page so long ranges stream.
+   # json and columnar responses both read through here, so limit means the same rows
+   if plan.source == "hot":
+       items = hot_readings.select(site_id, start_time, end_time, limit)
+       if items is not None:
+           yield items[::-1]
+           return
+
+   table = get_table(table_name)
+   kwargs = projection(fields) if fields else {}
+   kwargs.update(KeyConditionExpression=site_data_key(site_id, start_time, end_time), ScanIndexForward=False)
+   remaining = limit
+   while remaining > 0:
+       kwargs['Limit'] = remaining
+       response = table.query(**kwargs)
+       yield response['Items']
+       remaining -= len(response['Items'])
+       if 'LastEvaluatedKey' not in response:
+           return
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def query_site_data(site_id, start_time, end_time, limit, plan, fields=None, layout="rows"):
+   # follows pagination until `limit` readings, only reading the requested attributes
+   items = [item for page in iter_site_data_pages(site_id, start_time, end_time, limit, plan, fields) for item in page]
+   return shape_items({
+       "site_id":site_id,
+       "record_count": len(items)
+   }, "data", project_items(items, fields), fields, layout)
+
+# columnar responses: arrow ipc stream or parquet, picked by ?format= or the Accept header
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+COLUMNAR_ACCEPT = {ARROW_MEDIA_TYPE: "arrow", PARQUET_MEDIA_TYPE: "parquet", "application/x-parquet": "parquet"}
+COLUMNAR_MEDIA_TYPES = {"arrow": ARROW_MEDIA_TYPE, "parquet": PARQUET_MEDIA_TYPE}
+
+def response_format(request, format):
+   # an explicit ?format= wins over the Accept header
+   if format is None:
+       accept = request.headers.get("accept", "")
+       format = next((name for media_type, name in COLUMNAR_ACCEPT.items() if media_type in accept), "json")
+   if format != "json" and pa is None:
+       raise HTTPException(status_code=406, detail="Arrow and Parquet responses need pyarrow installed on the server")
+   return format
+
+def reading_schema(fields):
+   # typed columns, timestamps as real timestamps so they load straight into datetime64
+   types = {
+       'site_id': pa.string(),
+       'timestamp': pa.timestamp('us', tz='UTC'),
+       'energy_generated_kwh': pa.float64(),
+       'energy_consumed_kwh': pa.float64(),
+       'net_energy_kwh': pa.float64(),
+       'anomaly': pa.bool_(),
+       'processed_at': pa.timestamp('us', tz='UTC'),
+   }
+   return pa.schema([(field, types[field]) for field in fields or READING_FIELDS])
+
+def to_record_batch(items, schema):
+   arrays = []
+   for field in schema:
+       values = [item.get(field.name) for item in items]
+       if pa.types.is_timestamp(field.type):
+           parsed = np.array([value.rstrip('Z') if value else 'NaT' for value in values], dtype='datetime64[us]')
+           arrays.append(pa.array(parsed, type=field.type, from_pandas=True))
+       elif pa.types.is_floating(field.type):
+           arrays.append(pa.array([None if value is None else float(value) for value in values], type=field.type))
+       else:
+           arrays.append(pa.array(values, type=field.type))
+   return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def drain(sink):
+   chunk = sink.getvalue()
+   sink.seek(0)
+   sink.truncate()
+   return chunk
+
+def columnar_stream(pages, schema, format):
+   # one record batch (arrow) or row group (parquet) per dynamodb page, sent as soon
+   # as the writer has produced it
+   sink = io.BytesIO()
+   writer = pa.ipc.new_stream(sink, schema) if format == "arrow" else pq.ParquetWriter(sink, schema)
+   for items in pages:
+       if items:
+           writer.write_batch(to_record_batch(items, schema))
+           yield drain(sink)
+   writer.close()
+   yield drain(sink)
+
+async def columnar_response(request, route, params, pages, fields, format, scope=None, plan=None, filename="data"):
+   # the first page is read before the response starts, so a failing query is still a 500
+   headers = validators(route, params, scope)
+   if headers is not None and not_modified(request, headers):
+       return Response(status_code=304, headers=headers)
+   headers = dict(headers or {})
+   if plan is not None:
+       headers[QUERY_PLAN_HEADER] = describe_plan(plan)
+   if format == "parquet":
+       headers["Content-Disposition"] = f'attachment; filename="{filename}.parquet"'
+   first = await run_in_threadpool(next, pages, [])
+   return StreamingResponse(
+       columnar_stream(itertools.chain([first], pages), reading_schema(fields), format),
+       media_type=COLUMNAR_MEDIA_TYPES[format],
+       headers=headers
+   )
+
+# how many per-site queries run at once for fleet requests
+FLEET_QUERY_CONCURRENCY = 8
+FLEET_MAX_SITES = 100
+# lines per chunk written to the client
+FLEET_STREAM_BATCH = 500
+
+def query_readings_page(site_id, start_time, end_time, start_key=None):
+   # one page of a site's readings, oldest first
+   table = get_table(table_name)
+   kwargs = {
+       "KeyConditionExpression": Key('site_id').eq(site_id) & Key('timestamp').between(start_time, end_time),
+       "ScanIndexForward": True,
+   }
+   if start_key:
+       kwargs['ExclusiveStartKey'] = start_key
+   return table.query(**kwargs)
+
+async def fetch_readings_page(semaphore, site_id, start_time, end_time, start_key=None):
+   async with semaphore:
+       return await run_in_threadpool(query_readings_page, site_id, start_time, end_time, start_key)
+
+async def merge_site_readings(site_ids, start_time, end_time):
+   # query every site at once (bounded by the semaphore) and yield readings in
+   # timestamp order. each site's next page is fetched while the current one is
+   # being merged, and a failing site shows up as an error record instead of
+   # failing the whole response
+   semaphore = asyncio.Semaphore(FLEET_QUERY_CONCURRENCY)
+   pending = {}
+
+   def prefetch(site_id, start_key=None):
+       pending[site_id] = asyncio.create_task(fetch_readings_page(semaphore, site_id, start_time, end_time, start_key))
+
+   async def next_page(site_id):
+       # iterator over the site's next non-empty page, None when it has no more data
+       while site_id in pending:
+           response = await pending.pop(site_id)
+           if 'LastEvaluatedKey' in response:
+               prefetch(site_id, response['LastEvaluatedKey'])
+           if response['Items']:
+               return iter(response['Items'])
+       return None
+
+   heap = []
+   for site_id in site_ids:
+       prefetch(site_id)
+   try:
+       # every site has at most one entry on the heap, so the index breaks timestamp ties
+       for index, site_id in enumerate(site_ids):
+           try:
+               items = await next_page(site_id)
+           except Exception as e:
+               yield {"site_id": site_id, "error": str(e)}
+               continue
+           if items is not None:
+               item = next(items)
+               heap.append((item['timestamp'], index, site_id, item, items))
+       heapq.heapify(heap)
+
+       while heap:
+           _, index, site_id, item, items = heap[0]
+           yield item
+           following = next(items, None)
+           if following is None:
+               try:
+                   items = await next_page(site_id)
+               except Exception as e:
+                   heapq.heappop(heap)
+                   yield {"site_id": site_id, "error": str(e)}
+                   continue
+               if items is None:
+                   heapq.heappop(heap)
+                   continue
+               following = next(items)
+           heapq.heapreplace(heap, (following['timestamp'], index, site_id, following, items))
+   finally:
+       # client went away or we are done -- don't leave page fetches running
+       for task in pending.values():
+           task.cancel()
+
+@app.get("/sites/data", dependencies=[Depends(admission("fanout"))])
+async def get_fleet_data(
+   request: Request,
+   site_ids: str = Query(...),
+   start: Optional[str] = Query(None),
+   end: Optional[str] = Query(None)
+):
+   # readings for many sites in one call, streamed as newline delimited json
+   sites = sorted(set(site.strip() for site in site_ids.split(',') if site.strip()))
+   if not sites:
+       raise HTTPException(status_code=400, detail="site_ids is required")
+   if len(sites) > FLEET_MAX_SITES:
+       raise HTTPException(status_code=400, detail=f"Too many sites (max {FLEET_MAX_SITES})")
+   start_time, end_time = default_time_range(start, end)
+   headers = validators("fleet_data", {"site_ids": ",".join(sites), "start": start_time, "end": end_time}, sites)
+   if headers is not None and not_modified(request, headers):
+       return Response(status_code=304, headers=headers)
+
+   async def body():
+       lines = []
+       async for record in merge_site_readings(sites, start_time, end_time):
+           lines.append(dynamo_json_encoder.encode(record))
+           # flush errors right away, readings in batches
+           if len(lines) >= FLEET_STREAM_BATCH or 'error' in record:
+               yield "\n".join(lines) + "\n"
+               lines = []
+       if lines:
+           yield "\n".join(lines) + "\n"
+
+   return StreamingResponse(body(), media_type="application/x-ndjson", headers=headers)
+
+@app.get ("/sites/{site_id}/data", dependencies=[Depends(admission("query"))])
 async def get_site_data (
+   request: Request,
    site_id: str,
    start_time: Optional[str] =Query(None),
    end_time: Optional[str] =Query(None),
-   limit: int = Query(100)
+   limit: int = Query(100),
+   fields: Optional[str] = Query(None),
+   layout: str = Query("rows", pattern="^(rows|columns)$"),
+   format: Optional[str] = Query(None, pattern="^(json|arrow|parquet)$")
 ):
    # get energy data for a specific site
+   selected = parse_fields(fields)
+   plan = plan_site_data(site_id, start_time, end_time, limit)
+   format = response_format(request, format)
    try:
-       table = dynamodb.Table(table_name)
-       key_condition =Key('site_id').eq(site_id)
-       
-       # add time filters
-       if start_time and end_time:
-           key_condition =key_condition & Key('timestamp').between(start_time, end_time)
-       elif start_time:
-           key_condition = key_condition & Key('timestamp').gte(start_time)
-       elif end_time:
-           key_condition =key_condition & Key('timestamp').lte(end_time)
-       
-       # query the database
-       response =table.query(
-           KeyConditionExpression= key_condition,
-           Limit=limit,
-           ScanIndexForward= False  
-       )
-       
-       return {
-           "site_id":site_id,
-           "record_count": len(response['Items']),
-           "data":response['Items']
+       if format != "json":
+           response = await columnar_response(
+               request,
+               "site_data_" + format,
+               {"site_id": site_id, "start_time": start_time, "end_time": end_time, "limit": limit,
+                "fields": ",".join(selected) if selected else None},
+               iter_site_data_pages(site_id, start_time, end_time, limit, plan, selected),
+               selected,
+               format,
+               scope=site_id,
+               plan=plan,
+               filename=site_id
+           )
+       else:
+           response = await cached_json(
+               request,
+               "site_data",
+               {"site_id": site_id, "start_time": start_time, "end_time": end_time, "limit": limit,
+                "fields": ",".join(selected) if selected else None, "layout": layout},
+               lambda: query_site_data(site_id, start_time, end_time, limit, plan, selected, layout),
+               scope=site_id,
+               plan=plan
+           )
+       # the same url answers json or columnar depending on Accept
+       response.headers["Vary"] = "Accept"
+       return response
+
+   except Exception as e:
+       raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+# numeric columns we aggregate for time series
+SERIES_METRICS = ['energy_generated_kwh', 'energy_consumed_kwh', 'net_energy_kwh']
+# keeps series payloads bounded no matter how many readings are in range
+SERIES_MAX_BUCKETS = 2000
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+EPOCH = datetime(1970, 1, 1)
+
+def parse_duration(text):
+   # "30s", "5m", "1h", "7d" or plain seconds -> seconds
+   text = text.strip().lower()
+   try:
+       if text[-1] in DURATION_UNITS:
+           seconds = int(text[:-1]) * DURATION_UNITS[text[-1]]
+       else:
+           seconds = int(text)
+   except (ValueError, IndexError):
+       raise HTTPException(status_code=400, detail=f"Invalid duration: {text}")
+   if seconds <= 0:
+       raise HTTPException(status_code=400, detail=f"Invalid duration: {text}")
+   return seconds
+
+def parse_timestamp(text):
+   # readings are stored as utc iso strings with a trailing Z
+   try:
+       parsed = datetime.fromisoformat(text.rstrip('Z'))
+   except ValueError:
+       raise HTTPException(status_code=400, detail=f"Invalid timestamp: {text}")
+   if parsed.tzinfo is not None:
+       parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+   return parsed
+
+def default_time_range(start, end):
+   # last day unless told otherwise -- the default end is rounded up to the next
+   # minute so repeated calls share a cache entry. given bounds are converted to the
+   # stored utc Z form, the key conditions compare them as strings
+   start = start and parse_timestamp(start).isoformat() + 'Z'
+   end = end and parse_timestamp(end).isoformat() + 'Z'
+   end_time = end or (datetime.utcnow().replace(second=0, microsecond=0) + timedelta(minutes=1)).isoformat() + 'Z'
+   start_time = start or (parse_timestamp(end_time) - timedelta(days=1)).isoformat() + 'Z'
+   if parse_timestamp(start_time) > parse_timestamp(end_time):
+       raise HTTPException(status_code=400, detail="start must be before end")
+   return start_time, end_time
+
+def query_all(table, **kwargs):
+   # run a query to the end, following pagination
+   items = []
+   while True:
+       response = table.query(**kwargs)
+       items.extend(response['Items'])
+       if 'LastEvaluatedKey' not in response:
+           return items
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def query_site_readings(site_id, start_time, end_time, attributes):
+   # every reading in the range with (at least) the given attributes, from memory when
+   # the hot readings cover the range
+   items = hot_readings.select(site_id, start_time, end_time)
+   if items is not None:
+       return items
+   kwargs = projection(attributes)
+   kwargs["KeyConditionExpression"] = Key('site_id').eq(site_id) & Key('timestamp').between(start_time, end_time)
+   return query_all(get_table(table_name), **kwargs)
+
+def readings_to_arrays(items, metrics):
+   # epoch seconds plus one float array per metric, all sorted by time
+   times = np.array([item['timestamp'].rstrip('Z') for item in items], dtype='datetime64[us]')
+   seconds = times.astype('int64') / 1e6
+   columns = {metric: np.array([item.get(metric, 0) for item in items], dtype=float) for metric in metrics}
+   return seconds, columns
+
+def epoch_to_iso(seconds):
+   return [datetime.utcfromtimestamp(s).isoformat() + 'Z' for s in seconds.tolist()]
+
+def partial_aggregates(seconds, columns, origin, resolution):
+   # count plus sum/min/max per metric for every non-empty bucket. items come back from
+   # dynamodb in timestamp order, so each bucket is a contiguous slice and reduceat
+   # aggregates every bucket in one pass
+   bucket_ids = ((seconds - origin) // resolution).astype('int64')
+   starts = np.concatenate(([0], np.flatnonzero(np.diff(bucket_ids)) + 1))
+   partial = {"start": origin + bucket_ids[starts] * resolution, "count": np.diff(np.append(starts, len(bucket_ids)))}
+   for metric, values in columns.items():
+       partial[metric] = (np.add.reduceat(values, starts), np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts))
+   return partial
+
+def combine_partials(partials, metrics, origin, resolution):
+   # merge partial aggregates (e.g. hourly rollups plus raw edges) into coarser buckets
+   partials = [partial for partial in partials if len(partial["start"])]
+   starts = np.concatenate([partial["start"] for partial in partials])
+   order = np.argsort(starts, kind="stable")
+   counts = np.concatenate([partial["count"] for partial in partials])[order]
+   bucket_ids = ((starts[order] - origin) // resolution).astype('int64')
+   edges = np.concatenate(([0], np.flatnonzero(np.diff(bucket_ids)) + 1))
+   combined = {"start": origin + bucket_ids[edges] * resolution, "count": np.add.reduceat(counts, edges)}
+   for metric in metrics:
+       sums, mins, maxs = (np.concatenate([partial[metric][i] for partial in partials])[order] for i in range(3))
+       combined[metric] = (np.add.reduceat(sums, edges), np.minimum.reduceat(mins, edges), np.maximum.reduceat(maxs, edges))
+   return combined
+
+def format_buckets(partial, metrics):
+   result = {
+       "timestamps": epoch_to_iso(partial["start"]),
+       "count": partial["count"].tolist(),
+   }
+   for metric in metrics:
+       sums, mins, maxs = partial[metric]
+       result[metric] = {
+           "mean": (sums / partial["count"]).round(3).tolist(),
+           "min": mins.tolist(),
+           "max": maxs.tolist(),
+           "sum": sums.round(3).tolist(),
        }
-       
+   return result
+
+def rollup_partials(site_id, first_hour, end_hour, metrics):
+   # hourly rollups the lambda maintains, as partial aggregates
+   items = query_all(
+       get_table(stats_table_name),
+       KeyConditionExpression=Key('pk').eq(f'rollup#1h#{site_id}') & Key('sk').between(
+           first_hour.isoformat(), (end_hour - timedelta(hours=1)).isoformat())
+   )
+   items = [item for item in items if item.get('readings')]
+   seconds = np.array([(parse_timestamp(item['sk']) - EPOCH).total_seconds() for item in items], dtype=float)
+   partial = {"start": seconds, "count": np.array([int(item['readings']) for item in items], dtype='int64')}
+   for metric in metrics:
+       partial[metric] = tuple(np.array([item.get(f'{metric}_{kind}', 0) for item in items], dtype=float) for kind in ('sum', 'min', 'max'))
+   return partial
+
+def lttb(x, y, threshold):
+   # largest-triangle-three-buckets: keeps the points that preserve the visual shape
+   n = len(x)
+   if threshold >= n or threshold < 3:
+       return np.arange(n)
+   selected = np.empty(threshold, dtype='int64')
+   selected[0] = 0
+   selected[-1] = n - 1
+   # split everything between the first and last point into threshold - 2 buckets
+   edges = np.linspace(1, n - 1, threshold - 1).astype('int64')
+   a = 0
+   for i in range(threshold - 2):
+       lo, hi = edges[i], edges[i + 1]
+       # average of the next bucket (or the last point) is the third triangle vertex
+       if i + 2 < len(edges):
+           next_lo, next_hi = edges[i + 1], edges[i + 2]
+           avg_x, avg_y = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+       else:
+           avg_x, avg_y = x[n - 1], y[n - 1]
+       areas = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+       a = lo + int(np.argmax(areas))
+       selected[i + 1] = a
+   return selected
+
+def build_site_series(site_id, start_time, end_time, resolution, mode, metric, points, plan):
+   start = parse_timestamp(start_time)
+   metrics = SERIES_METRICS if mode == "aggregate" else [metric]
+   result = {"site_id": site_id, "start_time": start_time, "end_time": end_time, "mode": mode}
+   if mode == "aggregate":
+       result["resolution_seconds"] = resolution
+       # align buckets to whole multiples of the resolution
+       origin = (start - EPOCH).total_seconds() // resolution * resolution
+
+   if plan.source == "rollup_1h+raw":
+       # whole hours from the rollups, the partial hours at either end from raw readings
+       first_hour, end_hour = plan.detail
+       partials = [rollup_partials(site_id, first_hour, end_hour, metrics)]
+       for edge_start, edge_end in ((start_time, first_hour.isoformat()), (end_hour.isoformat(), end_time)):
+           if edge_start < edge_end:
+               edge = query_site_readings(site_id, edge_start, edge_end, ['timestamp'] + metrics)
+               if edge:
+                   seconds, columns = readings_to_arrays(edge, metrics)
+                   partials.append(partial_aggregates(seconds, columns, origin, resolution))
+       result["reading_count"] = int(sum(partial["count"].sum() for partial in partials))
+       if not result["reading_count"]:
+           result["timestamps"] = []
+           return result
+       result.update(format_buckets(combine_partials(partials, metrics, origin, resolution), metrics))
+       return result
+
+   items = query_site_readings(site_id, start_time, end_time, ['timestamp'] + metrics)
+   result["reading_count"] = len(items)
+   if not items:
+       result["timestamps"] = []
+       return result
+
+   seconds, columns = readings_to_arrays(items, metrics)
+   if mode == "aggregate":
+       result.update(format_buckets(partial_aggregates(seconds, columns, origin, resolution), metrics))
+   else:
+       keep = lttb(seconds, columns[metric], points)
+       result["timestamps"] = epoch_to_iso(seconds[keep])
+       result[metric] = columns[metric][keep].tolist()
+   return result
+
+@app.get("/sites/{site_id}/series", dependencies=[Depends(admission("fanout"))])
+async def get_site_series(
+   request: Request,
+   site_id: str,
+   start: Optional[str] = Query(None),
+   end: Optional[str] = Query(None),
+   resolution: str = Query("1h"),
+   mode: str = Query("aggregate", pattern="^(aggregate|lttb)$"),
+   metric: str = Query("net_energy_kwh"),
+   points: int = Query(500, ge=3, le=SERIES_MAX_BUCKETS)
+):
+   # downsampled time series, sized by bucket count instead of reading count
+   start_time, end_time = default_time_range(start, end)
+   resolution_seconds = parse_duration(resolution)
+   span = (parse_timestamp(end_time) - parse_timestamp(start_time)).total_seconds()
+   if mode == "aggregate" and span / resolution_seconds > SERIES_MAX_BUCKETS:
+       raise HTTPException(status_code=400, detail=f"Too many buckets, use a coarser resolution (max {SERIES_MAX_BUCKETS})")
+   if metric not in SERIES_METRICS:
+       raise HTTPException(status_code=400, detail=f"Unknown metric: {metric}")
+
+   plan = plan_series(site_id, start_time, end_time, resolution_seconds, mode)
+   try:
+       return await cached_json(
+           request,
+           "site_series",
+           {"site_id": site_id, "start": start_time, "end": end_time, "resolution": resolution_seconds,
+            "mode": mode, "metric": metric, "points": points},
+           lambda: build_site_series(site_id, start_time, end_time, resolution_seconds, mode, metric, points, plan),
+           scope=site_id,
+           plan=plan,
+           sliding=end is None
+       )
+
    except Exception as e:
        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-@app.get("/sites/{site_id}/anomalies")
-async def get_site_anomalies(site_id: str, limit: int = Query(50)):
+def query_indexed_anomalies(site_id, limit, since, fields=None):
+   # newest first from the sparse index, which only holds anomalies from `since` on
+   kwargs = projection(fields) if fields else {}
+   response = get_table(table_name).query(
+       IndexName=ANOMALY_INDEX_NAME,
+       KeyConditionExpression=Key('site_id').eq(site_id) & Key('anomaly_at').gte(since),
+       Limit=limit,
+       ScanIndexForward=False,
+       **kwargs
+   )
+   return response['Items']
+
+def query_raw_anomalies(site_id, limit, fields=None, before=None):
+   # newest first through the readings, the filter only runs after a page is read so
+   # keep paging until enough anomalies turn up
+   table = get_table(table_name)
+   key_condition = Key('site_id').eq(site_id)
+   if before:
+       key_condition = key_condition & Key('timestamp').lt(before)
+
+   # the filter still sees every attribute, the projection only trims what comes back
+   kwargs = projection(fields) if fields else {}
+   kwargs.update(
+       KeyConditionExpression=key_condition,
+       FilterExpression='anomaly = :anomaly_value',
+       ExpressionAttributeValues={':anomaly_value': True},
+       ScanIndexForward=False
+   )
+   items = []
+   while len(items) < limit:
+       kwargs['Limit'] = min(1000, int((limit - len(items)) / ANOMALY_RATE_ESTIMATE))
+       response = table.query(**kwargs)
+       items.extend(response['Items'])
+       if 'LastEvaluatedKey' not in response:
+           break
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+   return items[:limit]
+
+def query_site_anomalies(site_id, limit, plan, fields=None, layout="rows"):
+   if plan.source == "anomaly_index":
+       items = query_indexed_anomalies(site_id, limit, plan.detail, fields)
+       if len(items) < limit:
+           # anomalies older than the index coverage are only in the raw readings
+           items += query_raw_anomalies(site_id, limit - len(items), fields, before=plan.detail)
+   else:
+       items = query_raw_anomalies(site_id, limit, fields)
+
+   return shape_items({
+       "site_id":site_id,
+       "anomaly_count": len(items)
+   }, "anomalies", items, fields, layout)
+
+@app.get("/sites/{site_id}/anomalies", dependencies=[Depends(admission("query"))])
+async def get_site_anomalies(
+   request: Request,
+   site_id: str,
+   limit: int = Query(50),
+   fields: Optional[str] = Query(None),
+   layout: str = Query("rows", pattern="^(rows|columns)$")
+):
    # get only the problem records for a site
+   selected = parse_fields(fields)
+   plan = plan_anomalies(limit)
    try:
-       table = dynamodb.Table(table_name)
-       
-       response = table.query(
-           KeyConditionExpression=Key('site_id').eq(site_id),
-           FilterExpression='anomaly = :anomaly_value',
-           ExpressionAttributeValues={':anomaly_value': True},
-           Limit=limit,
-           ScanIndexForward=False
+       return await cached_json(
+           request,
+           "site_anomalies",
+           {"site_id": site_id, "limit": limit, "fields": ",".join(selected) if selected else None, "layout": layout},
+           lambda: query_site_anomalies(site_id, limit, plan, selected, layout),
+           scope=site_id,
+           plan=plan
        )
        
-       return {
-           "site_id":site_id,
-           "anomaly_count": len(response['Items']),
-           "anomalies": response['Items']
-       }
-       
    except Exception as e:
        raise HTTPException(status_code=500, detail= f" Error: {str(e)}")
 
-@app.get("/sites")
-async def get_all_sites():
-   # list all available sites
+# fleet-wide anomaly search
+ANOMALY_DAY_INDEX_NAME = 'anomaly-day-index'
+FLEET_ANOMALY_MAX_LIMIT = 1000
+FLEET_ANOMALY_MAX_DAYS = 31
+FLEET_ANOMALY_DEFAULT_WINDOW = timedelta(hours=1)
+
+def anomaly_cursor(item):
+   # the last anomaly returned is enough to resume: the day index continues from its key,
+   # the per-site queries from its timestamp with ties ordered by site id
+   return base64.urlsafe_b64encode(json.dumps([item['timestamp'], item['site_id']]).encode()).decode()
+
+def parse_anomaly_cursor(cursor, start_time, end_time):
    try:
-       table =dynamodb.Table(table_name)
-       response =table.scan(ProjectionExpression='site_id')
-       # remove duplicates and sort
-       sites = list(set ([item['site_id'] for item in response ['Items']]))
-       
+       timestamp, site_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+   except (ValueError, TypeError):
+       raise HTTPException(status_code=400, detail="Invalid cursor")
+   if not isinstance(timestamp, str) or not isinstance(site_id, str) or not start_time <= timestamp <= end_time:
+       raise HTTPException(status_code=400, detail="Invalid cursor")
+   return timestamp, site_id
+
+def query_anomaly_days(start_time, end_time, limit, after=None):
+   # newest first, one day partition at a time from the end of the range back. stops at
+   # limit + 1 anomalies, the extra one only says there are more
+   table = get_table(table_name)
+   day = parse_timestamp(after[0] if after else end_time).date()
+   first_day = parse_timestamp(start_time).date()
+   items = []
+   while day >= first_day and len(items) <= limit:
+       kwargs = {
+           "IndexName": ANOMALY_DAY_INDEX_NAME,
+           "KeyConditionExpression": Key('anomaly_day').eq(day.isoformat()) & Key('timestamp').between(start_time, end_time),
+           "ScanIndexForward": False,
+       }
+       if after and after[0][:10] == day.isoformat():
+           kwargs["ExclusiveStartKey"] = {'anomaly_day': day.isoformat(), 'timestamp': after[0], 'site_id': after[1]}
+       while len(items) <= limit:
+           kwargs["Limit"] = limit + 1 - len(items)
+           response = table.query(**kwargs)
+           items.extend(response['Items'])
+           if 'LastEvaluatedKey' not in response:
+               break
+           kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+       day -= timedelta(days=1)
+   return items[:limit], len(items) > limit
+
+def query_site_anomaly_range(site_id, start_time, end_time, limit, plan, after=None):
+   # up to limit + 1 of the site's newest anomalies in the range that sort after the cursor
+   upper = end_time
+   skip = None
+   if after:
+       upper = min(end_time, after[0])
+       # at the cursor timestamp only sites ordered after the cursor's site are left
+       if site_id <= after[1]:
+           skip = after[0]
+   kwargs = {"ScanIndexForward": False}
+   if plan.source == "anomaly_index":
+       kwargs.update(IndexName=ANOMALY_INDEX_NAME, KeyConditionExpression=Key('site_id').eq(site_id) & Key('anomaly_at').between(start_time, upper))
+   else:
+       kwargs.update(
+           KeyConditionExpression=Key('site_id').eq(site_id) & Key('timestamp').between(start_time, upper),
+           FilterExpression='anomaly = :anomaly_value',
+           ExpressionAttributeValues={':anomaly_value': True}
+       )
+   table = get_table(table_name)
+   items = []
+   while len(items) <= limit:
+       wanted = limit + 1 - len(items)
+       kwargs['Limit'] = wanted if plan.source == "anomaly_index" else min(1000, int(wanted / ANOMALY_RATE_ESTIMATE))
+       response = table.query(**kwargs)
+       items.extend(item for item in response['Items'] if item['timestamp'] != skip)
+       if 'LastEvaluatedKey' not in response:
+           break
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+   return items[:limit + 1]
+
+def merge_anomalies(per_site, limit):
+   # newest first across sites, ties by site id -- the order the cursor assumes
+   items = sorted(itertools.chain.from_iterable(per_site), key=lambda item: item['site_id'])
+   items.sort(key=lambda item: item['timestamp'], reverse=True)
+   return items[:limit], len(items) > limit
+
+async def load_fleet_anomalies(start_time, end_time, sites, limit, plan, after, fields, layout):
+   if plan.source == "anomaly_day_index":
+       items, more = await run_in_threadpool(query_anomaly_days, start_time, end_time, limit, after)
+   else:
+       semaphore = asyncio.Semaphore(FLEET_QUERY_CONCURRENCY)
+
+       async def fetch(site_id):
+           async with semaphore:
+               return await run_in_threadpool(query_site_anomaly_range, site_id, start_time, end_time, limit, plan, after)
+
+       items, more = merge_anomalies(await asyncio.gather(*[fetch(site_id) for site_id in sites or await known_sites()]), limit)
+   return shape_items({
+       "start": start_time,
+       "end": end_time,
+       "anomaly_count": len(items),
+       "has_more": more,
+       "next_cursor": anomaly_cursor(items[-1]) if more else None
+   }, "anomalies", project_items(items, fields), fields, layout)
+
+@app.get("/anomalies", dependencies=[Depends(admission("fanout"))])
+async def get_fleet_anomalies(
+   request: Request,
+   start: Optional[str] = Query(None),
+   end: Optional[str] = Query(None),
+   site_ids: Optional[str] = Query(None),
+   limit: int = Query(100, ge=1, le=FLEET_ANOMALY_MAX_LIMIT),
+   cursor: Optional[str] = Query(None),
+   fields: Optional[str] = Query(None),
+   layout: str = Query("rows", pattern="^(rows|columns)$")
+):
+   # anomalies of every site (or the given ones) in a time range, newest first, the last
+   # hour by default. pass next_cursor back as cursor for the next page
+   selected = parse_fields(fields)
+   sites = sorted(set(site.strip() for site in site_ids.split(',') if site.strip())) if site_ids else None
+   if sites is not None and len(sites) > FLEET_MAX_SITES:
+       raise HTTPException(status_code=400, detail=f"Too many sites (max {FLEET_MAX_SITES})")
+   start_time, end_time = default_time_range(start, end)
+   if start is None:
+       start_time = (parse_timestamp(end_time) - FLEET_ANOMALY_DEFAULT_WINDOW).isoformat() + 'Z'
+   if parse_timestamp(end_time) - parse_timestamp(start_time) > timedelta(days=FLEET_ANOMALY_MAX_DAYS):
+       raise HTTPException(status_code=400, detail=f"Range is longer than {FLEET_ANOMALY_MAX_DAYS} days")
+   after = parse_anomaly_cursor(cursor, start_time, end_time) if cursor else None
+   plan = plan_fleet_anomalies(start_time, end_time, sites, limit)
+   try:
+       return await cached_json(
+           request,
+           "fleet_anomalies",
+           {"start": start_time, "end": end_time, "site_ids": ",".join(sites) if sites else None, "limit": limit,
+            "cursor": cursor, "fields": ",".join(selected) if selected else None, "layout": layout},
+           functools.partial(load_fleet_anomalies, start_time, end_time, sites, limit, plan, after, selected, layout),
+           plan=plan,
+           sliding=end is None
+       )
+
+   except Exception as e:
+       raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+def query_site_totals():
+   # one item per site, kept up to date by the lambda
+   items = query_all(get_table(stats_table_name), KeyConditionExpression=Key('pk').eq('totals'))
+   _last_reads["totals"] = len(items)
+   return items
+
+def scan_sites():
+   table = get_table(table_name)
+   # every page, fleet-wide routes without site_ids rely on this list being complete
+   kwargs = {"ProjectionExpression": 'site_id'}
+   sites = set()
+   reads = 0
+   while True:
+       response = table.scan(**kwargs)
+       reads += len(response['Items'])
+       # remove duplicates
+       sites.update(item['site_id'] for item in response['Items'])
+       if 'LastEvaluatedKey' not in response:
+           break
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+   _last_reads["scan"] = reads
+   sites = list(sites)
+
+   return {"sites": sorted(sites), "site_count": len(sites)}
+
+def list_sites(plan):
+   if plan.source == "totals":
+       sites = [item['sk'] for item in query_site_totals()]
        return {"sites": sorted(sites), "site_count": len(sites)}
-       
+   return scan_sites()
+
+@app.get("/sites", dependencies=[Depends(admission(totals_cost_class))])
+async def get_all_sites(request: Request):
+   # list all available sites
+   plan = plan_totals()
+   try:
+       return await cached_json(request, "sites", {}, lambda: list_sites(plan), plan=plan)
+
    except Exception as e:
        raise HTTPException(status_code= 500, detail= f"Error: {str(e)}")
 
-@app.get("/analytics/summary")
-async def get_analytics_summary():
-   # get overall stats for all sites
-   try:
-       table = dynamodb.Table(table_name)
-       response =table.scan()
-       items =response['Items']
-       
-       total_records = len(items)
-       total_anomalies = sum(1 for item in items if item.get('anomaly', False))
-       
-       # calculate stats for each site
-       site_stats ={}
-       for item in items:
-           site_id =item['site_id']
-           if site_id not in site_stats:
-               site_stats[site_id] ={'records': 0,'anomalies': 0, 'total_generated':0, 'total_consumed': 0}
-           
-           site_stats[site_id]['records']+=1
-           if item.get ('anomaly', False):
-               site_stats[site_id]['anomalies'] +=1
-           
-           # add up energy totals
-           site_stats[site_id]['total_generated'] +=item.get('energy_generated_kwh',0)
-           site_stats[site_id]['total_consumed'] += item.get('energy_consumed_kwh', 0)
-       
+async def known_sites():
+   # shares the /sites cache entry
+   plan = plan_totals()
+   return (await response_cache.get_or_load("sites", {}, lambda: list_sites(plan)))["sites"]
+
+# live feed settings
+STREAM_POLL_SECONDS = 10
+# readings that land late (lambda lag, clock skew) inside this window are still picked up
+STREAM_OVERLAP = timedelta(minutes=10)
+# events buffered per client before we start dropping for that client
+STREAM_QUEUE_SIZE = 1000
+STREAM_HEARTBEAT_SECONDS = 15
+
+def query_readings_since(site_id, since):
+   # every reading of a site newer than the given timestamp, oldest first
+   return query_all(
+       get_table(table_name),
+       KeyConditionExpression=Key('site_id').eq(site_id) & Key('timestamp').gt(since),
+       ScanIndexForward=True
+   )
+
+class StreamSubscriber:
+   # one connected client: a bounded queue plus the sites it cares about
+   def __init__(self, site_ids):
+       self.site_ids = site_ids
+       self.queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+       self.dropped = 0
+
+class ChangeFeed:
+   # a single poll loop shared by every /stream client. it only runs while someone
+   # is connected and fans new readings out to per-client queues, so N clients
+   # cost one set of queries per interval instead of N
+
+   def __init__(self):
+       self.subscribers = set()
+       self._task = None
+       self._watermark = None
+       # (site_id, timestamp) of readings already published inside the overlap window
+       self._seen = {}
+       self.polls = 0
+       self.published = 0
+       self.dropped = 0
+
+   def subscribe(self, site_ids=None):
+       subscriber = StreamSubscriber(site_ids)
+       self.subscribers.add(subscriber)
+       if self._task is None or self._task.done():
+           self._task = asyncio.create_task(self._run())
+       return subscriber
+
+   def unsubscribe(self, subscriber):
+       self.subscribers.discard(subscriber)
+       if not self.subscribers and self._task is not None:
+           self._task.cancel()
+           self._task = None
+
+   async def _run(self):
+       self._watermark = datetime.utcnow().isoformat() + 'Z'
+       self._seen = {}
+       # the first poll only remembers what is already there
+       prime = True
+       while True:
+           try:
+               await self.poll(publish=not prime)
+               prime = False
+           except Exception as e:
+               logger.exception(f"Error polling change feed: {str(e)}")
+           await asyncio.sleep(STREAM_POLL_SECONDS)
+
+   async def poll(self, publish=True):
+       sites = await known_sites()
+       since = (parse_timestamp(self._watermark) - STREAM_OVERLAP).isoformat() + 'Z'
+       semaphore = asyncio.Semaphore(FLEET_QUERY_CONCURRENCY)
+
+       async def fetch(site_id):
+           async with semaphore:
+               return await run_in_threadpool(query_readings_since, site_id, since)
+
+       results = await asyncio.gather(*[fetch(site_id) for site_id in sites], return_exceptions=True)
+       self.polls += 1
+
+       fresh = []
+       for site_id, items in zip(sites, results):
+           if isinstance(items, Exception):
+               logger.error(f"Error polling change feed for {site_id}: {str(items)}", exc_info=items)
+               continue
+           for item in items:
+               key = (item['site_id'], item['timestamp'])
+               if key not in self._seen:
+                   self._seen[key] = item['timestamp']
+                   fresh.append(item)
+
+       fresh.sort(key=lambda item: item['timestamp'])
+       if fresh:
+           self._watermark = max(self._watermark, fresh[-1]['timestamp'])
+       # forget readings that fell out of the overlap window
+       self._seen = {key: timestamp for key, timestamp in self._seen.items() if timestamp > since}
+       if publish:
+           for item in fresh:
+               self.publish(item)
+
+   def publish(self, item):
+       self.published += 1
+       for subscriber in self.subscribers:
+           if subscriber.site_ids and item['site_id'] not in subscriber.site_ids:
+               continue
+           try:
+               subscriber.queue.put_nowait(item)
+           except asyncio.QueueFull:
+               # slow client: drop for that client only and tell it once it catches up
+               subscriber.dropped += 1
+               self.dropped += 1
+
+   def stats(self):
        return {
-           "total_records": total_records,
-           "total_anomalies":total_anomalies,
-           "anomaly_rate":(total_anomalies / total_records * 100) if total_records > 0 else 0 ,
-           "site_count": len(site_stats),
-           "site_statistics": site_stats
+           "subscribers": len(self.subscribers),
+           "running": self._task is not None and not self._task.done(),
+           "watermark": self._watermark,
+           "polls": self.polls,
+           "published": self.published,
+           "dropped": self.dropped,
        }
-       
+
+change_feed = ChangeFeed()
+
+def sse_event(event, data, event_id=None):
+   lines = [f"event: {event}"]
+   if event_id:
+       lines.append(f"id: {event_id}")
+   lines.append(f"data: {dynamo_json_encoder.encode(data)}")
+   return "\n".join(lines) + "\n\n"
+
+@app.get("/stream", dependencies=[Depends(admission("stream"))])
+async def stream_readings(site_ids: Optional[str] = Query(None)):
+   # server-sent events for newly ingested readings ("reading") and anomalies ("anomaly")
+   sites = set(site.strip() for site in site_ids.split(',') if site.strip()) if site_ids else None
+   subscriber = change_feed.subscribe(sites)
+
+   async def events():
+       try:
+           yield f"retry: {STREAM_POLL_SECONDS * 1000}\n\n"
+           while True:
+               try:
+                   item = await asyncio.wait_for(subscriber.queue.get(), STREAM_HEARTBEAT_SECONDS)
+               except asyncio.TimeoutError:
+                   # comment line keeps proxies from closing an idle connection
+                   yield ": keepalive\n\n"
+                   continue
+               if subscriber.dropped:
+                   yield sse_event("lagged", {"dropped": subscriber.dropped})
+                   subscriber.dropped = 0
+               event = "anomaly" if item.get('anomaly', False) else "reading"
+               yield sse_event(event, item, f"{item['site_id']}/{item['timestamp']}")
+       finally:
+           change_feed.unsubscribe(subscriber)
+
+   return StreamingResponse(
+       events(),
+       media_type="text/event-stream",
+       headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+   )
+
+@app.get("/stream/stats")
+async def get_stream_stats():
+   return change_feed.stats()
+
+# incremental sync: readings in processing order from the processed-day index
+CHANGES_INDEX_NAME = 'processed-day-index'
+CHANGES_MAX_LIMIT = 5000
+# older watermarks have to reload everything instead of walking every day since
+CHANGES_MAX_DAYS = 31
+# readings processed more recently than this may still be missing from the index
+# (concurrent lambdas, index lag), so the watermark never moves past them yet
+CHANGES_SETTLE_SECONDS = 10
+
+def query_changes(since, limit):
+   # readings processed after the watermark, one query per day bucket. a batch never
+   # ends inside a run of equal processed_at values, so `> next_since` on the next call
+   # can't skip anything. also returns the watermark to continue from
+   table = get_table(table_name)
+   now = datetime.utcnow()
+   settled = (now - timedelta(seconds=CHANGES_SETTLE_SECONDS)).isoformat()
+   if since >= settled:
+       return [], False, since
+   day = parse_timestamp(since).date()
+   # one day ahead in case the lambda's clock is ahead of ours around midnight
+   last_day = now.date() + timedelta(days=1)
+   items = []
+   while day <= last_day:
+       kwargs = {
+           "IndexName": CHANGES_INDEX_NAME,
+           "KeyConditionExpression": Key('processed_day').eq(day.isoformat()) & Key('processed_at').between(since, settled),
+           "Limit": limit + 1,
+       }
+       while True:
+           response = table.query(**kwargs)
+           for item in response['Items']:
+               if item['processed_at'] == since:
+                   continue
+               if len(items) >= limit and item['processed_at'] != items[-1]['processed_at']:
+                   return items, True, items[-1]['processed_at']
+               items.append(item)
+           if 'LastEvaluatedKey' not in response:
+               break
+           kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+       day += timedelta(days=1)
+   # everything up to the settled bound has been read, even if nothing was there
+   return items, False, settled
+
+def load_changes(since, limit, fields=None, layout="rows"):
+   items, more, next_since = query_changes(since, limit)
+   return shape_items({
+       "since": since,
+       "next_since": next_since,
+       "change_count": len(items),
+       "has_more": more
+   }, "changes", project_items(items, fields), fields, layout)
+
+@app.get("/changes", dependencies=[Depends(admission("query"))])
+async def get_changes(
+   since: str = Query(...),
+   limit: int = Query(1000, ge=1, le=CHANGES_MAX_LIMIT),
+   fields: Optional[str] = Query(None),
+   layout: str = Query("rows", pattern="^(rows|columns)$")
+):
+   # readings processed after `since` (a processed_at watermark). pass next_since back on
+   # the following call, and call again right away while has_more is true
+   selected = parse_fields(fields)
+   watermark = parse_timestamp(since)
+   if datetime.utcnow() - watermark > timedelta(days=CHANGES_MAX_DAYS):
+       raise HTTPException(status_code=400, detail=f"since is more than {CHANGES_MAX_DAYS} days old, reload the data instead")
+   # stored processed_at values have no Z suffix, compare against the same form
+   since = watermark.isoformat()
+   try:
+       result = await run_in_threadpool(load_changes, since, limit, selected, layout)
+       return DynamoJSONResponse(result, headers={"Cache-Control": "no-store"})
+
+   except Exception as e:
+       raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+def scan_analytics_summary():
+   table = get_table(table_name)
+   # every page, totals from only the first one would be silently wrong
+   kwargs = {}
+   site_stats ={}
+   reads = 0
+   while True:
+       response =table.scan(**kwargs)
+       add_site_stats(site_stats, response['Items'])
+       reads += len(response['Items'])
+       if 'LastEvaluatedKey' not in response:
+           break
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+   _last_reads["scan"] = reads
+
+   return summary_response(site_stats)
+
+def add_site_stats(site_stats, items):
+   # calculate stats for each site
+   for item in items:
+       site_id =item['site_id']
+       if site_id not in site_stats:
+           site_stats[site_id] ={'records': 0,'anomalies': 0, 'total_generated':0, 'total_consumed': 0}
+
+       site_stats[site_id]['records']+=1
+       if item.get ('anomaly', False):
+           site_stats[site_id]['anomalies'] +=1
+
+       # add up energy totals
+       site_stats[site_id]['total_generated'] +=item.get('energy_generated_kwh',0)
+       site_stats[site_id]['total_consumed'] += item.get('energy_consumed_kwh', 0)
+
+def totals_analytics_summary():
+   site_stats = {}
+   for item in query_site_totals():
+       site_stats[item['sk']] = {
+           'records': item.get('readings', 0),
+           'anomalies': item.get('anomalies', 0),
+           'total_generated': item.get('total_generated', 0),
+           'total_consumed': item.get('total_consumed', 0)
+       }
+   return summary_response(site_stats)
+
+def summary_response(site_stats):
+   total_records = sum(stats['records'] for stats in site_stats.values())
+   total_anomalies = sum(stats['anomalies'] for stats in site_stats.values())
+   return {
+       "total_records": total_records,
+       "total_anomalies":total_anomalies,
+       "anomaly_rate":(total_anomalies / total_records * 100) if total_records > 0 else 0 ,
+       "site_count": len(site_stats),
+       "site_statistics": site_stats
+   }
+
+@app.get("/analytics/summary", dependencies=[Depends(admission(totals_cost_class))])
+async def get_analytics_summary(request: Request):
+   # get overall stats for all sites
+   plan = plan_totals()
+   loader = totals_analytics_summary if plan.source == "totals" else scan_analytics_summary
+   try:
+       return await cached_json(request, "analytics_summary", {}, loader, plan=plan)
+
    except Exception as e:
        raise HTTPException(status_code=500, detail= f" Error: {str(e)}")
 
+# ranking settings
+TOP_METRICS = ['anomaly_rate', 'anomalies', 'readings', 'net_energy_kwh', 'energy_generated_kwh', 'energy_consumed_kwh']
+TOP_MAX_K = 100
+# longest window ranked from hourly rollups, "all" reads the all-time totals instead
+TOP_MAX_WINDOW = timedelta(days=90)
+
+def site_window_aggregates(site_id, first_hour, last_hour):
+   # readings, anomalies and energy sums over the site's hourly rollups in the window
+   items = query_all(
+       get_table(stats_table_name),
+       KeyConditionExpression=Key('pk').eq(f'rollup#1h#{site_id}') & Key('sk').between(first_hour.isoformat(), last_hour.isoformat())
+   )
+   totals = {'readings': 0, 'anomalies': 0, 'energy_generated_kwh': 0, 'energy_consumed_kwh': 0, 'net_energy_kwh': 0}
+   for item in items:
+       totals['readings'] += item.get('readings', 0)
+       totals['anomalies'] += item.get('anomalies', 0)
+       for metric in SERIES_METRICS:
+           totals[metric] += item.get(f'{metric}_sum', 0)
+   return totals
+
+def totals_aggregates(item):
+   generated = item.get('total_generated', 0)
+   consumed = item.get('total_consumed', 0)
+   return {
+       'readings': item.get('readings', 0),
+       'anomalies': item.get('anomalies', 0),
+       'energy_generated_kwh': generated,
+       'energy_consumed_kwh': consumed,
+       'net_energy_kwh': generated - consumed,
+   }
+
+def rank_sites(aggregates, metric, k, order):
+   # bounded heap: O(sites log k) no matter how many sites there are
+   entries = []
+   for site_id, totals in sorted(aggregates.items()):
+       if not totals['readings']:
+           continue
+       if metric == 'anomaly_rate':
+           value = totals['anomalies'] / totals['readings'] * 100
+       else:
+           value = totals[metric]
+       entries.append(dict(totals, site_id=site_id, value=value))
+   pick = heapq.nlargest if order == "desc" else heapq.nsmallest
+   return len(entries), pick(k, entries, key=lambda entry: entry['value'])
+
+async def load_top_sites(metric, k, window, order, plan):
+   result = {"metric": metric, "k": k, "window": window, "order": order}
+   if plan.source == "totals":
+       aggregates = {item['sk']: totals_aggregates(item) for item in await run_in_threadpool(query_site_totals)}
+       result["window_start"] = None
+   else:
+       first_hour, last_hour = plan.detail
+       sites = await known_sites()
+       semaphore = asyncio.Semaphore(FLEET_QUERY_CONCURRENCY)
+
+       async def fetch(site_id):
+           async with semaphore:
+               return await run_in_threadpool(site_window_aggregates, site_id, first_hour, last_hour)
+
+       aggregates = dict(zip(sites, await asyncio.gather(*[fetch(site_id) for site_id in sites])))
+       result["window_start"] = first_hour.isoformat() + 'Z'
+   result["complete"] = plan.reason != "window older than rollups"
+   result["site_count"], result["top"] = rank_sites(aggregates, metric, k, order)
+   return result
+
+def window_hours(window):
+   # first and last hourly bucket of a trailing window, the current hour included
+   span = timedelta(seconds=parse_duration(window))
+   if span > TOP_MAX_WINDOW:
+       raise HTTPException(status_code=400, detail=f"Window too long (max {TOP_MAX_WINDOW.days}d)")
+   hours = max(1, int(span.total_seconds() // 3600))
+   last_hour = floor_hour(datetime.utcnow())
+   return last_hour - timedelta(hours=hours - 1), last_hour
+
+def estimate_rollup_reads(first_hour, last_hour, sites=None):
+   # one rollup item per site per hour
+   sites = sites or (len(_ingest_state) if _ingest_state else None)
+   hours = int((last_hour - first_hour).total_seconds() // 3600) + 1
+   return sites and sites * hours
+
+def plan_top(window):
+   # whole windows come from the hourly rollups (the current hour included), "all"
+   # from the per-site totals
+   if window == "all":
+       if not _aggregate_coverage.get('totals_complete'):
+           raise HTTPException(status_code=503, detail="All-time totals are incomplete, run the aggregate backfill first")
+       return QueryPlan("totals", _last_reads["totals"], "all-time totals")
+   first_hour, last_hour = window_hours(window)
+   since = _aggregate_coverage.get('rollups_since')
+   reason = "per-site hourly rollups"
+   if not since or first_hour.isoformat() < since:
+       reason = "window older than rollups"
+   return QueryPlan("rollup_1h", estimate_rollup_reads(first_hour, last_hour), reason, (first_hour, last_hour))
+
+@app.get("/analytics/top", dependencies=[Depends(admission("fanout"))])
+async def get_top_sites(
+   request: Request,
+   metric: str = Query("anomaly_rate"),
+   k: int = Query(10, ge=1, le=TOP_MAX_K),
+   window: str = Query("24h"),
+   order: str = Query("desc", pattern="^(asc|desc)$")
+):
+   # rank sites by a metric over a recent window, from the aggregates the lambda keeps
+   if metric not in TOP_METRICS:
+       raise HTTPException(status_code=400, detail=f"Unknown metric: {metric}")
+   plan = plan_top(window)
+   try:
+       params = {"metric": metric, "k": k, "order": order, "window": window}
+       if plan.detail:
+           # the window slides every hour
+           params["first_hour"] = plan.detail[0].isoformat()
+       return await cached_json(
+           request,
+           "analytics_top",
+           params,
+           functools.partial(load_top_sites, metric, k, window, order, plan),
+           plan=plan,
+           sliding=plan.detail is not None
+       )
+
+   except Exception as e:
+       raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+# percentiles from the quantile sketches the lambda keeps in every hourly rollup. the
+# layout matches encode_sketch in lambda/data_processor.py
+SKETCH_GAMMA = (1 + 0.01) / (1 - 0.01)
+SKETCH_FORMAT = 1
+PERCENTILE_DEFAULT = "50,95,99"
+
+def read_varint(data, pos):
+   value = shift = 0
+   while True:
+       byte = data[pos]
+       pos += 1
+       value |= (byte & 0x7f) << shift
+       if byte < 0x80:
+           return value, pos
+       shift += 7
+
+def decode_sketch(data):
+   # {'zero': count, 'pos': {bucket: count}, 'neg': {bucket: count}}
+   if data[0] != SKETCH_FORMAT:
+       raise ValueError(f"Unknown sketch format {data[0]}")
+   sketch = {'zero': 0, 'pos': {}, 'neg': {}}
+   sketch['zero'], pos = read_varint(data, 1)
+   for name in ('pos', 'neg'):
+       size, pos = read_varint(data, pos)
+       index = 0
+       for _ in range(size):
+           delta, pos = read_varint(data, pos)
+           index += delta // 2 if delta % 2 == 0 else -(delta + 1) // 2
+           sketch[name][index], pos = read_varint(data, pos)
+   return sketch
+
+def merge_sketch(into, sketch):
+   into['zero'] += sketch['zero']
+   for name in ('pos', 'neg'):
+       store = into[name]
+       for index, count in sketch[name].items():
+           store[index] = store.get(index, 0) + count
+   return into
+
+def sketch_quantiles(sketch, quantiles):
+   # walk the buckets from the most negative value up. a bucket stands for the value
+   # halfway (relatively) between its bounds, which is what keeps the error relative
+   buckets = [(-2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1), count) for index, count in sorted(sketch['neg'].items(), reverse=True)]
+   buckets.append((0.0, sketch['zero']))
+   buckets += [(2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1), count) for index, count in sorted(sketch['pos'].items())]
+   total = sum(count for _, count in buckets)
+   result = {"count": total}
+   if not total:
+       return result
+   cumulative = np.cumsum([count for _, count in buckets])
+   for quantile in quantiles:
+       rank = quantile / 100 * (total - 1)
+       position = int(np.searchsorted(cumulative, rank, side='right'))
+       result[f"p{quantile:g}"] = round(buckets[min(position, len(buckets) - 1)][0], 3)
+   return result
+
+def site_window_sketches(site_id, first_hour, last_hour, metrics):
+   # one merged sketch per metric over the site's hourly rollups in the window
+   kwargs = projection([f'{metric}_sketch' for metric in metrics])
+   kwargs["KeyConditionExpression"] = Key('pk').eq(f'rollup#1h#{site_id}') & Key('sk').between(first_hour.isoformat(), last_hour.isoformat())
+   merged = {metric: {'zero': 0, 'pos': {}, 'neg': {}} for metric in metrics}
+   for item in query_all(get_table(stats_table_name), **kwargs):
+       for metric in metrics:
+           data = item.get(f'{metric}_sketch')
+           if data is not None:
+               merge_sketch(merged[metric], decode_sketch(bytes(data)))
+   return merged
+
+def parse_quantiles(text):
+   try:
+       quantiles = [float(part) for part in text.split(',') if part.strip()]
+   except ValueError:
+       raise HTTPException(status_code=400, detail=f"Invalid quantiles: {text}")
+   if not quantiles or any(not 0 <= quantile <= 100 for quantile in quantiles):
+       raise HTTPException(status_code=400, detail="Quantiles must be between 0 and 100")
+   return quantiles
+
+async def load_percentiles(site_ids, metrics, quantiles, first_hour, last_hour):
+   sites = site_ids or await known_sites()
+   semaphore = asyncio.Semaphore(FLEET_QUERY_CONCURRENCY)
+
+   async def fetch(site_id):
+       async with semaphore:
+           return await run_in_threadpool(site_window_sketches, site_id, first_hour, last_hour, metrics)
+
+   per_site = await asyncio.gather(*[fetch(site_id) for site_id in sites])
+   fleet = {metric: {'zero': 0, 'pos': {}, 'neg': {}} for metric in metrics}
+   result = {}
+   for site_id, sketches in zip(sites, per_site):
+       result[site_id] = {metric: sketch_quantiles(sketches[metric], quantiles) for metric in metrics}
+       for metric in metrics:
+           merge_sketch(fleet[metric], sketches[metric])
+
+   since = _aggregate_coverage.get('sketches_since')
+   return {
+       "window_start": first_hour.isoformat() + 'Z',
+       "window_end": (last_hour + timedelta(hours=1)).isoformat() + 'Z',
+       "complete": bool(since) and first_hour >= floor_hour(parse_timestamp(since)) + timedelta(hours=1),
+       "relative_accuracy": 0.01,
+       "fleet": {metric: sketch_quantiles(fleet[metric], quantiles) for metric in metrics},
+       "sites": result,
+   }
+
+@app.get("/analytics/percentiles", dependencies=[Depends(admission("fanout"))])
+async def get_percentiles(
+   request: Request,
+   site_ids: Optional[str] = Query(None),
+   metrics: str = Query("energy_generated_kwh,energy_consumed_kwh"),
+   q: str = Query(PERCENTILE_DEFAULT),
+   window: str = Query("24h")
+):
+   # percentiles per site and fleet wide over a trailing window, merged from hourly
+   # sketches so the cost is one rollup item per site per hour
+   selected_metrics = [metric.strip() for metric in metrics.split(',') if metric.strip()]
+   unknown = [metric for metric in selected_metrics if metric not in SERIES_METRICS]
+   if unknown or not selected_metrics:
+       raise HTTPException(status_code=400, detail=f"Unknown metrics: {', '.join(unknown)}")
+   quantiles = parse_quantiles(q)
+   sites = sorted(set(site.strip() for site in site_ids.split(',') if site.strip())) if site_ids else None
+   if sites is not None and len(sites) > FLEET_MAX_SITES:
+       raise HTTPException(status_code=400, detail=f"Too many sites (max {FLEET_MAX_SITES})")
+   first_hour, last_hour = window_hours(window)
+   plan = QueryPlan("sketch_1h", estimate_rollup_reads(first_hour, last_hour, sites and len(sites)), "hourly quantile sketches")
+   try:
+       return await cached_json(
+           request,
+           "analytics_percentiles",
+           {"site_ids": ",".join(sites) if sites else None, "metrics": ",".join(selected_metrics),
+            "q": ",".join(f"{quantile:g}" for quantile in quantiles), "first_hour": first_hour.isoformat(), "window": window},
+           functools.partial(load_percentiles, sites, selected_metrics, quantiles, first_hour, last_hour),
+           plan=plan,
+           sliding=True
+       )
+
+   except Exception as e:
+       raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+# time histograms from the per-day counters the lambda keeps (histogram_counts in
+# lambda/data_processor.py): one item per site per day, or one for the whole fleet,
+# with a readings_HHMM / anomalies_HHMM attribute per 5-minute slot
+HISTOGRAM_METRICS = ['anomalies', 'readings']
+HISTOGRAM_BUCKETS = {'5m': timedelta(minutes=5), '1h': timedelta(hours=1), '1d': timedelta(days=1)}
+# range when no start is given
+HISTOGRAM_DEFAULT_RANGE = {'5m': timedelta(days=1), '1h': timedelta(days=7), '1d': timedelta(days=90)}
+HISTOGRAM_MAX_BUCKETS = 5000
+HISTOGRAM_FLEET_KEY = 'histogram#fleet'
+
+def floor_bucket(moment, size):
+   # buckets start at midnight utc, so 5m and 1h buckets line up with the clock
+   midnight = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+   return midnight + (moment - midnight) // size * size
+
+def histogram_slots(pk, first, end, metric):
+   # (slot start, count) for every counted 5-minute slot in the day items covering the range
+   items = query_all(
+       get_table(stats_table_name),
+       KeyConditionExpression=Key('pk').eq(pk) & Key('sk').between(first.date().isoformat(), end.date().isoformat())
+   )
+   prefix = f"{metric}_"
+   for item in items:
+       day = datetime.fromisoformat(item['sk'])
+       for name, value in item.items():
+           if name.startswith(prefix):
+               slot = name[len(prefix):]
+               yield day + timedelta(hours=int(slot[:2]), minutes=int(slot[2:])), int(value)
+
+def dense_counts(slots, first, size, buckets):
+   # every bucket present, empty ones as 0
+   counts = [0] * buckets
+   for moment, count in slots:
+       index = (moment - first) // size
+       if 0 <= index < buckets:
+           counts[index] += count
+   return counts
+
+async def load_histogram(metric, bucket, sites, first, end):
+   size = HISTOGRAM_BUCKETS[bucket]
+   buckets = -(-(end - first) // size)
+   since = _aggregate_coverage.get('histograms_since')
+   result = {
+       "metric": metric,
+       "bucket": bucket,
+       "start": first.isoformat() + 'Z',
+       "end": (first + buckets * size).isoformat() + 'Z',
+       "bucket_seconds": int(size.total_seconds()),
+       # earlier readings were never counted, so buckets before the counters started are low
+       "complete": bool(since) and first >= parse_timestamp(since),
+   }
+   if not sites:
+       slots = await run_in_threadpool(lambda: list(histogram_slots(HISTOGRAM_FLEET_KEY, first, end, metric)))
+       result["counts"] = dense_counts(slots, first, size, buckets)
+       return result
+
+   semaphore = asyncio.Semaphore(FLEET_QUERY_CONCURRENCY)
+
+   async def fetch(site_id):
+       async with semaphore:
+           slots = await run_in_threadpool(lambda: list(histogram_slots(f"histogram#site#{site_id}", first, end, metric)))
+       return dense_counts(slots, first, size, buckets)
+
+   per_site = await asyncio.gather(*[fetch(site_id) for site_id in sites])
+   result["counts"] = [sum(column) for column in zip(*per_site)]
+   result["sites"] = dict(zip(sites, per_site))
+   return result
+
+def histogram_cost_class(request):
+   # fleet histograms read one counter item per day, site_ids fan out to a query per site
+   return "fanout" if request.query_params.get("site_ids") else "query"
+
+@app.get("/analytics/histogram", dependencies=[Depends(admission(histogram_cost_class))])
+async def get_histogram(
+   request: Request,
+   metric: str = Query("anomalies", pattern="^(anomalies|readings)$"),
+   bucket: str = Query("1h", pattern="^(5m|1h|1d)$"),
+   site_ids: Optional[str] = Query(None),
+   start: Optional[str] = Query(None),
+   end: Optional[str] = Query(None)
+):
+   # dense per-bucket counts for charts, fleet wide or summed over the given sites (each
+   # site's own counts are included too). reads one small counter item per day and site
+   sites = sorted(set(site.strip() for site in site_ids.split(',') if site.strip())) if site_ids else None
+   if sites is not None and len(sites) > FLEET_MAX_SITES:
+       raise HTTPException(status_code=400, detail=f"Too many sites (max {FLEET_MAX_SITES})")
+   start_time, end_time = default_time_range(start, end)
+   end_moment = parse_timestamp(end_time)
+   first = floor_bucket(parse_timestamp(start_time) if start else end_moment - HISTOGRAM_DEFAULT_RANGE[bucket], HISTOGRAM_BUCKETS[bucket])
+   if (end_moment - first) / HISTOGRAM_BUCKETS[bucket] > HISTOGRAM_MAX_BUCKETS:
+       raise HTTPException(status_code=400, detail=f"Too many buckets (max {HISTOGRAM_MAX_BUCKETS}), use a bigger bucket or a shorter range")
+   days = (end_moment.date() - first.date()).days + 1
+   plan = QueryPlan("histogram_counters", days * (len(sites) if sites else 1), "per-day ingest counters")
+   try:
+       return await cached_json(
+           request,
+           "analytics_histogram",
+           {"metric": metric, "bucket": bucket, "site_ids": ",".join(sites) if sites else None, "start": first.isoformat(), "end": end_time},
+           functools.partial(load_histogram, metric, bucket, sites, first, end_moment),
+           plan=plan,
+           sliding=end is None
+       )
+
+   except Exception as e:
+       raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+# bulk exports: background jobs writing gzip csv or parquet parts, one folder per site,
+# to a local directory or to s3 when ENERGY_API_EXPORT_BUCKET is set
+EXPORT_DIR = os.environ.get("ENERGY_API_EXPORT_DIR", "exports")
+EXPORT_BUCKET = os.environ.get("ENERGY_API_EXPORT_BUCKET")
+EXPORT_FORMATS = {"csv": ".csv.gz", "parquet": ".parquet"}
+# rows per part file, a new part is started after this many
+EXPORT_PART_ROWS = 100000
+EXPORT_MAX_DAYS = 366
+# jobs running at once and sites each job reads at once. memory is one dynamodb
+# page per site being read
+EXPORT_MAX_RUNNING = 2
+EXPORT_QUERY_CONCURRENCY = 4
+# more unfinished jobs than this and new ones are turned away
+EXPORT_MAX_PENDING = 10
+# finished jobs are forgotten oldest first past this many
+EXPORT_MAX_JOBS = 100
+
+# job id -> status dict returned by GET /exports/{id}. kept per process, so with several
+# workers ask the one that took the job (or read the manifest it writes at the end)
+export_jobs = OrderedDict()
+_export_tasks = set()
+_export_slots = None
+_s3_client = None
+
+class ExportRequest(BaseModel):
+   site_ids: Optional[List[str]] = None
+   start: Optional[str] = None
+   end: Optional[str] = None
+   format: str = "csv"
+   fields: Optional[List[str]] = None
+
+def s3_client():
+   global _s3_client
+   if _s3_client is None:
+       _s3_client = boto3.client('s3', region_name='us-east-1')
+   return _s3_client
+
+class ExportPartWriter:
+   # one site's readings as numbered parts of at most EXPORT_PART_ROWS rows. parts are
+   # written to local files and uploaded to s3 (then removed) as each one is closed
+   def __init__(self, job, site_id, staging):
+       self.job = job
+       self.site_id = site_id
+       self.folder = f"site_id={site_id}"
+       self.staging = os.path.join(staging, self.folder)
+       self.fields = job["fields"] or READING_FIELDS
+       self.number = 0
+       self.rows = 0
+       self.path = None
+       self.file = None
+       self.writer = None
+
+   def open(self):
+       os.makedirs(self.staging, exist_ok=True)
+       self.path = os.path.join(self.staging, f"part-{self.number:05d}{EXPORT_FORMATS[self.job['format']]}")
+       if self.job["format"] == "csv":
+           self.file = gzip.open(self.path, "wt", newline="")
+           self.writer = csv.DictWriter(self.file, fieldnames=self.fields, extrasaction="ignore")
+           self.writer.writeheader()
+       else:
+           self.writer = pq.ParquetWriter(self.path, reading_schema(self.fields), compression="gzip")
+
+   def write(self, items):
+       # returns the parts closed on the way
+       parts = []
+       while items:
+           if self.writer is None:
+               self.open()
+           chunk = items[:EXPORT_PART_ROWS - self.rows]
+           items = items[len(chunk):]
+           if self.job["format"] == "csv":
+               self.writer.writerows(chunk)
+           else:
+               self.writer.write_batch(to_record_batch(chunk, reading_schema(self.fields)))
+           self.rows += len(chunk)
+           if self.rows >= EXPORT_PART_ROWS:
+               parts.append(self.close())
+       return parts
+
+   def close(self):
+       if self.writer is None:
+           return None
+       if self.file is not None:
+           self.file.close()
+       else:
+           self.writer.close()
+       size = os.path.getsize(self.path)
+       name = f"{self.folder}/{os.path.basename(self.path)}"
+       if EXPORT_BUCKET:
+           key = f"exports/{self.job['id']}/{name}"
+           s3_client().upload_file(self.path, EXPORT_BUCKET, key)
+           os.remove(self.path)
+           location = f"s3://{EXPORT_BUCKET}/{key}"
+       else:
+           location = os.path.abspath(self.path)
+       part = {"site_id": self.site_id, "location": location, "rows": self.rows, "bytes": size}
+       self.number += 1
+       self.rows = 0
+       self.path = self.file = self.writer = None
+       return part
+
+   def discard(self):
+       # drop the part being written when the export stops early, it was never listed
+       if self.writer is None:
+           return
+       try:
+           if self.file is not None:
+               self.file.close()
+           else:
+               self.writer.close()
+       finally:
+           os.remove(self.path)
+           self.path = self.file = self.writer = None
+
+async def run_to_completion(func, *args):
+   # threadpool call that a cancelled task still waits for, so no write to staging
+   # outlives the export that owns it
+   future = asyncio.ensure_future(run_in_threadpool(func, *args))
+   try:
+       return await asyncio.shield(future)
+   except asyncio.CancelledError:
+       await asyncio.wait([future])
+       raise
+
+async def export_site(job, site_id, staging, semaphore):
+   # page by page, oldest first -- only the page being written is held in memory.
+   # files are written in the threadpool, the job is only updated on the event loop
+   async with semaphore:
+       writer = ExportPartWriter(job, site_id, staging)
+       start_key = None
+       try:
+           while True:
+               response = await run_to_completion(query_readings_page, site_id, job["start"], job["end"], start_key)
+               add_export_parts(job, await run_to_completion(writer.write, response['Items']))
+               job["rows_written"] += len(response['Items'])
+               start_key = response.get('LastEvaluatedKey')
+               if not start_key:
+                   break
+           add_export_parts(job, [await run_to_completion(writer.close)])
+       except BaseException:
+           writer.discard()
+           raise
+   job["sites_done"] += 1
+   job["progress"] = job["sites_done"] / job["sites_total"]
+
+def add_export_parts(job, parts):
+   for part in parts:
+       if part is not None:
+           job["parts"].append(part)
+           job["bytes_written"] += part["bytes"]
+
+def write_export_manifest(job, staging):
+   body = dynamo_json_encoder.encode(dict(job, status="completed")).encode("utf-8")
+   if EXPORT_BUCKET:
+       s3_client().put_object(Bucket=EXPORT_BUCKET, Key=f"exports/{job['id']}/manifest.json", Body=body, ContentType="application/json")
+       job["manifest"] = f"s3://{EXPORT_BUCKET}/exports/{job['id']}/manifest.json"
+   else:
+       # a job that found no readings never created its folder
+       os.makedirs(staging, exist_ok=True)
+       path = os.path.join(staging, "manifest.json")
+       with open(path, "wb") as f:
+           f.write(body)
+       job["manifest"] = os.path.abspath(path)
+
+async def run_export(job):
+   global _export_slots
+   if _export_slots is None:
+       _export_slots = asyncio.Semaphore(EXPORT_MAX_RUNNING)
+   async with _export_slots:
+       job["status"] = "running"
+       job["started_at"] = datetime.utcnow().isoformat()
+       # s3 exports only stage the part being written locally
+       staging = tempfile.mkdtemp(prefix=f"export-{job['id']}-") if EXPORT_BUCKET else os.path.join(EXPORT_DIR, job["id"])
+       try:
+           sites = job["site_ids"] or await known_sites()
+           job["sites_total"] = len(sites)
+           semaphore = asyncio.Semaphore(EXPORT_QUERY_CONCURRENCY)
+           tasks = [asyncio.create_task(export_site(job, site_id, staging, semaphore)) for site_id in sites]
+           try:
+               await asyncio.gather(*tasks)
+           except BaseException:
+               # stop the other sites before the job reports failed and frees its slot
+               for task in tasks:
+                   task.cancel()
+               await asyncio.gather(*tasks, return_exceptions=True)
+               raise
+           job["progress"] = 1.0
+           job["finished_at"] = datetime.utcnow().isoformat()
+           # the manifest lands before the job reports completed
+           await run_in_threadpool(write_export_manifest, job, staging)
+           job["status"] = "completed"
+       except Exception as e:
+           # parts written so far stay where they are and are listed in the job
+           job["status"] = "failed"
+           job["error"] = str(e)
+           job["finished_at"] = datetime.utcnow().isoformat()
+           logger.exception(f"Error exporting {job['id']}: {str(e)}")
+       finally:
+           if EXPORT_BUCKET:
+               shutil.rmtree(staging, ignore_errors=True)
+
+@app.post("/exports", status_code=202)
+async def create_export(export: ExportRequest):
+   # start a background export of readings in a time range (the last day by default),
+   # poll GET /exports/{id} for progress and the list of parts
+   if export.format not in EXPORT_FORMATS:
+       raise HTTPException(status_code=400, detail=f"Unknown format: {export.format}")
+   if export.format == "parquet" and pa is None:
+       raise HTTPException(status_code=400, detail="Parquet exports need pyarrow installed on the server")
+   fields = parse_fields(",".join(export.fields)) if export.fields else None
+   sites = sorted(set(site.strip() for site in export.site_ids if site.strip())) if export.site_ids else None
+   if sites is not None and len(sites) > FLEET_MAX_SITES:
+       raise HTTPException(status_code=400, detail=f"Too many sites (max {FLEET_MAX_SITES})")
+   start_time, end_time = default_time_range(export.start, export.end)
+   if parse_timestamp(end_time) - parse_timestamp(start_time) > timedelta(days=EXPORT_MAX_DAYS):
+       raise HTTPException(status_code=400, detail=f"Range is longer than {EXPORT_MAX_DAYS} days")
+   pending = sum(1 for job in export_jobs.values() if job["status"] in ("queued", "running"))
+   if pending >= EXPORT_MAX_PENDING:
+       raise HTTPException(status_code=503, detail="Too many exports in progress, try again later", headers={"Retry-After": "60"})
+
+   job = {
+       "id": uuid.uuid4().hex,
+       "status": "queued",
+       "format": export.format,
+       "site_ids": sites,
+       "start": start_time,
+       "end": end_time,
+       "fields": fields,
+       "created_at": datetime.utcnow().isoformat(),
+       "started_at": None,
+       "finished_at": None,
+       "sites_total": len(sites) if sites else None,
+       "sites_done": 0,
+       "progress": 0.0,
+       "rows_written": 0,
+       "bytes_written": 0,
+       "parts": [],
+       "manifest": None,
+       "error": None,
+   }
+   export_jobs[job["id"]] = job
+   while len(export_jobs) > EXPORT_MAX_JOBS:
+       oldest = next((key for key, value in export_jobs.items() if value["status"] in ("completed", "failed")), None)
+       if oldest is None:
+           break
+       del export_jobs[oldest]
+   task = asyncio.create_task(run_export(job))
+   _export_tasks.add(task)
+   task.add_done_callback(_export_tasks.discard)
+   return JSONResponse(job, status_code=202, headers={"Location": f"/exports/{job['id']}"})
+
+@app.get("/exports/{export_id}")
+async def get_export(export_id: str):
+   # status, progress and the parts written so far
+   job = export_jobs.get(export_id)
+   if job is None:
+       raise HTTPException(status_code=404, detail="Export not found")
+   return JSONResponse(job, headers={"Cache-Control": "no-store"})
+
 if __name__ == "__main__":
    # run the server locally
    import uvicorn
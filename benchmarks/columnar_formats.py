@@ -0,0 +1,62 @@
+import io
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from json_encoding import make_items
+
+# import the api app from the sibling folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from app import DynamoJSONResponse, columnar_stream, reading_schema
+
+ITEM_COUNT = 100000
+ROUNDS = 5
+# the api writes one batch per dynamodb page
+PAGE_SIZE = 3000
+
+def pages(items):
+   return [items[i:i + PAGE_SIZE] for i in range(0, len(items), PAGE_SIZE)]
+
+def json_round_trip(items):
+   # encode like the api, decode like a client building a dataframe
+   body = DynamoJSONResponse({'site_id': 'SITE_001', 'record_count': len(items), 'data': items}).body
+   frame = pd.DataFrame(json.loads(body)['data'])
+   frame['timestamp'] = pd.to_datetime(frame['timestamp'])
+   frame['processed_at'] = pd.to_datetime(frame['processed_at'])
+   return body, frame
+
+def arrow_round_trip(items):
+   body = b''.join(columnar_stream(iter(pages(items)), reading_schema(None), 'arrow'))
+   return body, pa.ipc.open_stream(body).read_all().to_pandas()
+
+def parquet_round_trip(items):
+   body = b''.join(columnar_stream(iter(pages(items)), reading_schema(None), 'parquet'))
+   return body, pq.read_table(io.BytesIO(body)).to_pandas()
+
+def measure(round_trip, items):
+   round_trip(items)
+   timings = []
+   for _ in range(ROUNDS):
+       start = time.perf_counter()
+       body, frame = round_trip(items)
+       timings.append(time.perf_counter() - start)
+   timings.sort()
+   return {'median_ms': timings[len(timings) // 2] * 1000, 'bytes': len(body), 'rows': len(frame)}
+
+def main():
+   items = make_items(ITEM_COUNT)
+   print(f"{ITEM_COUNT} items to a pandas DataFrame, {ROUNDS} rounds (server encode + client decode)")
+   baseline = None
+   for name, round_trip in (('json', json_round_trip), ('arrow ipc stream', arrow_round_trip), ('parquet', parquet_round_trip)):
+       result = measure(round_trip, items)
+       assert result['rows'] == ITEM_COUNT
+       baseline = baseline or result['median_ms']
+       print(f"  {name:<18} median {result['median_ms']:8.2f} ms   {result['bytes']:>12,} bytes   {baseline / result['median_ms']:5.1f}x")
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,64 @@
+import json
+import os
+import sys
+import time
+import zlib
+
+from json_encoding import make_items
+
+# import the api app from the sibling folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from app import DynamoJSONResponse, StreamCompressor, brotli, dynamo_json_encoder
+
+ROUNDS = 5
+# brotli 11 is left out, it runs at well under 1 MB/s and is no use for live responses
+LEVELS = {"gzip": [1, 6, 9], "deflate": [1, 6, 9], "br": [1, 4, 6, 9]}
+# the fleet route streams ndjson in chunks of this many lines
+STREAM_BATCH = 500
+
+def payloads():
+   # a 10k-reading site data range, a 100-site summary, and the same readings as streamed ndjson
+   items = make_items(10000)
+   site_data = DynamoJSONResponse({'site_id': 'SITE_001', 'record_count': len(items), 'data': items}).body
+   stats = {f"SITE_{i:03d}": {'records': 28800 + i, 'anomalies': 1400 + i, 'total_generated': 3600000.5 + i, 'total_consumed': 2700000.25 + i} for i in range(1, 101)}
+   summary = json.dumps({"total_records": 2880000, "total_anomalies": 140000, "anomaly_rate": 4.86, "site_count": 100, "site_statistics": stats}).encode()
+   lines = [dynamo_json_encoder.encode(item).encode() + b"\n" for item in items]
+   chunks = [b"".join(lines[i:i + STREAM_BATCH]) for i in range(0, len(lines), STREAM_BATCH)]
+   return [("site data, 10k rows", [site_data]), ("summary, 100 sites", [summary]), ("fleet ndjson, streamed", chunks)]
+
+def decompress(encoding, body):
+   if encoding == "br":
+       return brotli.decompress(body)
+   return zlib.decompress(body, 31 if encoding == "gzip" else 15)
+
+def measure(encoding, level, chunks):
+   # compress the chunks like the middleware does (flush after each, finish on the last)
+   compress_times = []
+   decompress_times = []
+   for _ in range(ROUNDS):
+       compressor = StreamCompressor(encoding, level)
+       start = time.perf_counter()
+       body = b"".join(compressor.compress(chunk, final=i == len(chunks) - 1) for i, chunk in enumerate(chunks))
+       compress_times.append(time.perf_counter() - start)
+       start = time.perf_counter()
+       assert decompress(encoding, body) == b"".join(chunks)
+       decompress_times.append(time.perf_counter() - start)
+   compress_times.sort()
+   decompress_times.sort()
+   return len(body), compress_times[ROUNDS // 2], decompress_times[ROUNDS // 2]
+
+def main():
+   encodings = [encoding for encoding in LEVELS if encoding != "br" or brotli is not None]
+   if brotli is None:
+       print("brotli is not installed, skipping br")
+   for name, chunks in payloads():
+       size = sum(len(chunk) for chunk in chunks)
+       print(f"\n{name}: {size:,} bytes in {len(chunks)} chunk(s), median of {ROUNDS} rounds")
+       for encoding in encodings:
+           for level in LEVELS[encoding]:
+               compressed, compress_time, decompress_time = measure(encoding, level, chunks)
+               print(f"  {encoding:<8} level {level:>2}   {compressed:>10,} bytes  {size / compressed:6.1f}x   "
+                     f"compress {compress_time * 1000:8.2f} ms ({size / compress_time / 1e6:7.1f} MB/s)   decompress {decompress_time * 1000:6.2f} ms")
+
+if __name__ == "__main__":
+   main()
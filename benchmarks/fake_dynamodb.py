@@ -0,0 +1,336 @@
+import bisect
+import copy
+import re
+import threading
+import time
+from collections import defaultdict
+
+# a small in-process stand-in for the boto3 dynamodb resource. it supports the calls
+# the api makes (query, scan, get_item, put_item, update_item) with the same request
+# and response shapes, so the real route code runs unchanged against it
+
+# key schema of every table the api talks to
+KEY_SCHEMAS = {
+   'energy-data-analytics-energy-data': ('site_id', 'timestamp'),
+   'energy-data-analytics-energy-stats': ('pk', 'sk'),
+}
+
+class FakeDynamoDB:
+   def __init__(self, latency=0.0, page_size=1000):
+       # latency is added to every call to stand in for the network round trip
+       self.latency = latency
+       self.page_size = page_size
+       self.tables = {}
+       self.calls = defaultdict(int)
+       self._lock = threading.Lock()
+
+   def Table(self, name):
+       with self._lock:
+           if name not in self.tables:
+               hash_key, range_key = KEY_SCHEMAS[name]
+               self.tables[name] = FakeTable(self, name, hash_key, range_key)
+           return self.tables[name]
+
+   def record_call(self, operation):
+       with self._lock:
+           self.calls[operation] += 1
+       if self.latency:
+           time.sleep(self.latency)
+
+   def reset_calls(self):
+       with self._lock:
+           self.calls.clear()
+
+class Partition:
+   # items of one partition kept sorted by range key
+   def __init__(self):
+       self.keys = []
+       self.items = []
+
+   def put(self, range_value, item):
+       index = bisect.bisect_left(self.keys, range_value)
+       if index < len(self.keys) and self.keys[index] == range_value:
+           self.items[index] = item
+       else:
+           self.keys.insert(index, range_value)
+           self.items.insert(index, item)
+
+class FakeIndex:
+   # global secondary index: only items that have both key attributes are indexed
+   def __init__(self, hash_key, range_key):
+       self.hash_key = hash_key
+       self.range_key = range_key
+       self.partitions = defaultdict(Partition)
+
+   def put(self, table_key, item):
+       if self.hash_key in item and self.range_key in item:
+           # the table key keeps entries with the same index range value apart
+           self.partitions[item[self.hash_key]].put((item[self.range_key],) + table_key, item)
+
+class FakeTable:
+   def __init__(self, resource, name, hash_key, range_key):
+       self.resource = resource
+       self.name = name
+       self.hash_key = hash_key
+       self.range_key = range_key
+       self.partitions = defaultdict(Partition)
+       self.indexes = {}
+       self._lock = threading.Lock()
+
+   def add_index(self, name, hash_key, range_key):
+       index = FakeIndex(hash_key, range_key)
+       for partition in self.partitions.values():
+           for item in partition.items:
+               index.put(self._table_key(item), item)
+       self.indexes[name] = index
+
+   def _table_key(self, item):
+       return (item[self.hash_key], item[self.range_key])
+
+   def put_item(self, Item, **kwargs):
+       self.resource.record_call('PutItem')
+       self._store(copy.deepcopy(Item))
+       return {}
+
+   def _store(self, item):
+       with self._lock:
+           self.partitions[item[self.hash_key]].put(item[self.range_key], item)
+           for index in self.indexes.values():
+               index.put(self._table_key(item), item)
+
+   def batch_writer(self, **kwargs):
+       return FakeBatchWriter(self)
+
+   def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+       self.resource.record_call('GetItem')
+       partition = self.partitions.get(Key[self.hash_key])
+       if partition is None:
+           return {}
+       index = bisect.bisect_left(partition.keys, Key[self.range_key])
+       if index == len(partition.keys) or partition.keys[index] != Key[self.range_key]:
+           return {}
+       return {'Item': project(partition.items[index], ProjectionExpression, ExpressionAttributeNames)}
+
+   def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None, ReturnValues=None, **kwargs):
+       self.resource.record_call('UpdateItem')
+       with self._lock:
+           partition = self.partitions.get(Key[self.hash_key])
+           existing = None
+           if partition is not None:
+               index = bisect.bisect_left(partition.keys, Key[self.range_key])
+               if index < len(partition.keys) and partition.keys[index] == Key[self.range_key]:
+                   existing = partition.items[index]
+           item = copy.deepcopy(existing) if existing is not None else dict(Key)
+       apply_update(item, UpdateExpression, ExpressionAttributeValues or {}, ExpressionAttributeNames or {})
+       self._store(item)
+       if ReturnValues == 'ALL_NEW':
+           return {'Attributes': copy.deepcopy(item)}
+       return {}
+
+   def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None, ExpressionAttributeValues=None, Limit=None, ScanIndexForward=True,
+             ExclusiveStartKey=None, Select=None, **kwargs):
+       self.resource.record_call('Query')
+       source = self.indexes[IndexName] if IndexName else self
+       hash_value, range_condition = split_key_condition(KeyConditionExpression, source.hash_key)
+       partition = source.partitions.get(hash_value)
+       if partition is None:
+           return {'Items': [], 'Count': 0, 'ScannedCount': 0}
+
+       lo, hi = range_bounds(partition.keys, range_condition, wrapped=IndexName is not None)
+       if ExclusiveStartKey is not None:
+           start = ExclusiveStartKey[source.range_key]
+           if IndexName:
+               start = (start,) + (ExclusiveStartKey[self.hash_key], ExclusiveStartKey[self.range_key])
+           if ScanIndexForward:
+               lo = max(lo, bisect.bisect_right(partition.keys, start))
+           else:
+               hi = min(hi, bisect.bisect_left(partition.keys, start))
+
+       positions = range(lo, hi) if ScanIndexForward else range(hi - 1, lo - 1, -1)
+       limit = min(Limit or self.resource.page_size, self.resource.page_size)
+       evaluated = [partition.items[i] for i in positions[:limit]]
+       items = [item for item in evaluated if matches(FilterExpression, item, ExpressionAttributeNames, ExpressionAttributeValues)]
+
+       response = {'Count': len(items), 'ScannedCount': len(evaluated)}
+       if Select == 'COUNT':
+           response['Items'] = []
+       else:
+           response['Items'] = [project(item, ProjectionExpression, ExpressionAttributeNames) for item in items]
+       if len(positions) > limit:
+           last = evaluated[-1]
+           key = {self.hash_key: last[self.hash_key], self.range_key: last[self.range_key]}
+           if IndexName:
+               key.update({source.hash_key: last[source.hash_key], source.range_key: last[source.range_key]})
+           response['LastEvaluatedKey'] = key
+       return response
+
+   def scan(self, FilterExpression=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+            ExpressionAttributeValues=None, Limit=None, ExclusiveStartKey=None, Segment=None, TotalSegments=None, **kwargs):
+       self.resource.record_call('Scan')
+       limit = min(Limit or self.resource.page_size, self.resource.page_size)
+       hash_values = sorted(self.partitions)
+       if TotalSegments:
+           hash_values = [value for value in hash_values if hash(value) % TotalSegments == Segment]
+
+       start = None
+       if ExclusiveStartKey is not None:
+           start = (ExclusiveStartKey[self.hash_key], ExclusiveStartKey[self.range_key])
+       evaluated = []
+       more = False
+       for hash_value in hash_values:
+           if start is not None and hash_value < start[0]:
+               continue
+           partition = self.partitions[hash_value]
+           lo = bisect.bisect_right(partition.keys, start[1]) if start is not None and hash_value == start[0] else 0
+           for item in partition.items[lo:]:
+               if len(evaluated) == limit:
+                   more = True
+                   break
+               evaluated.append(item)
+           if more:
+               break
+
+       items = [item for item in evaluated if matches(FilterExpression, item, ExpressionAttributeNames, ExpressionAttributeValues)]
+       response = {
+           'Items': [project(item, ProjectionExpression, ExpressionAttributeNames) for item in items],
+           'Count': len(items),
+           'ScannedCount': len(evaluated),
+       }
+       if more:
+           response['LastEvaluatedKey'] = {self.hash_key: evaluated[-1][self.hash_key], self.range_key: evaluated[-1][self.range_key]}
+       return response
+
+class FakeBatchWriter:
+   def __init__(self, table):
+       self.table = table
+
+   def __enter__(self):
+       return self
+
+   def __exit__(self, *exc_info):
+       return False
+
+   def put_item(self, Item):
+       self.table._store(copy.deepcopy(Item))
+
+def split_key_condition(condition, hash_key):
+   # "hash = x AND <range condition>" -> (x, range condition or None)
+   expression = condition.get_expression()
+   if expression['operator'] == 'AND':
+       left, right = expression['values']
+       if left.get_expression()['values'][0].name == hash_key:
+           return left.get_expression()['values'][1], right
+       return right.get_expression()['values'][1], left
+   return expression['values'][1], None
+
+def range_bounds(keys, condition, wrapped=False):
+   # slice of the sorted range keys that satisfies the range condition.
+   # index keys are tuples led by the index range value
+   if condition is None:
+       return 0, len(keys)
+   expression = condition.get_expression()
+   operator = expression['operator']
+   values = expression['values'][1:]
+   low_key = (lambda value: (value,)) if wrapped else (lambda value: value)
+   high_key = (lambda value: (value, chr(0x10FFFF))) if wrapped else (lambda value: value)
+   if operator == '=':
+       return bisect.bisect_left(keys, low_key(values[0])), bisect.bisect_right(keys, high_key(values[0]))
+   if operator == 'BETWEEN':
+       return bisect.bisect_left(keys, low_key(values[0])), bisect.bisect_right(keys, high_key(values[1]))
+   if operator == '>':
+       return bisect.bisect_right(keys, high_key(values[0])), len(keys)
+   if operator == '>=':
+       return bisect.bisect_left(keys, low_key(values[0])), len(keys)
+   if operator == '<':
+       return 0, bisect.bisect_left(keys, low_key(values[0]))
+   if operator == '<=':
+       return 0, bisect.bisect_right(keys, high_key(values[0]))
+   if operator == 'begins_with':
+       return bisect.bisect_left(keys, low_key(values[0])), bisect.bisect_left(keys, low_key(values[0] + chr(0x10FFFF)))
+   raise NotImplementedError(f"Unsupported key condition: {operator}")
+
+def resolve_name(name, names):
+   return (names or {}).get(name, name)
+
+def project(item, projection, names):
+   if not projection:
+       return copy.copy(item)
+   fields = [resolve_name(field.strip(), names) for field in projection.split(',')]
+   return {field: item[field] for field in fields if field in item}
+
+def matches(condition, item, names, values):
+   if condition is None:
+       return True
+   if isinstance(condition, str):
+       return matches_string(condition, item, names or {}, values or {})
+   expression = condition.get_expression()
+   operator = expression['operator']
+   operands = expression['values']
+   if operator == 'AND':
+       return all(matches(operand, item, names, values) for operand in operands)
+   if operator == 'OR':
+       return any(matches(operand, item, names, values) for operand in operands)
+   if operator == 'NOT':
+       return not matches(operands[0], item, names, values)
+   name = operands[0].name
+   if operator == 'attribute_exists':
+       return name in item
+   if operator == 'attribute_not_exists':
+       return name not in item
+   if name not in item:
+       return False
+   return compare(item[name], operator, operands[1:])
+
+def compare(value, operator, operands):
+   if operator == '=':
+       return value == operands[0]
+   if operator == '<>':
+       return value != operands[0]
+   if operator == '<':
+       return value < operands[0]
+   if operator == '<=':
+       return value <= operands[0]
+   if operator == '>':
+       return value > operands[0]
+   if operator == '>=':
+       return value >= operands[0]
+   if operator == 'BETWEEN':
+       return operands[0] <= value <= operands[1]
+   if operator == 'IN':
+       return value in operands[0]
+   if operator == 'begins_with':
+       return value.startswith(operands[0])
+   raise NotImplementedError(f"Unsupported filter operator: {operator}")
+
+COMPARISON = re.compile(r'^\s*(\S+)\s*(=|<>|<=|>=|<|>)\s*(\S+)\s*$')
+
+def matches_string(expression, item, names, values):
+   # only "name op :value" clauses joined with AND, which is all the api writes by hand
+   for clause in re.split(r'\s+AND\s+', expression):
+       match = COMPARISON.match(clause)
+       if match is None:
+           raise NotImplementedError(f"Unsupported filter expression: {expression}")
+       name = resolve_name(match.group(1), names)
+       if name not in item or not compare(item[name], match.group(2), [values[match.group(3)]]):
+           return False
+   return True
+
+def apply_update(item, expression, values, names):
+   # SET a = :x, b = if_not_exists(b, :y) and ADD c :z clauses
+   for action, body in re.findall(r'(SET|ADD)\s+(.*?)(?=\s+(?:SET|ADD)\s+|$)', expression.strip()):
+       # commas inside if_not_exists(...) don't separate clauses
+       for clause in [clause.strip() for clause in re.split(r',(?![^(]*\))', body) if clause.strip()]:
+           if action == 'ADD':
+               name, placeholder = clause.split()
+               name = resolve_name(name, names)
+               item[name] = item.get(name, 0) + values[placeholder]
+               continue
+           name, value = [part.strip() for part in clause.split('=', 1)]
+           name = resolve_name(name, names)
+           fallback = re.match(r'if_not_exists\(\s*(\S+)\s*,\s*(\S+)\s*\)', value)
+           if fallback:
+               if name not in item:
+                   item[name] = values[fallback.group(2)]
+           else:
+               item[name] = values[value]
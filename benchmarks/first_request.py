@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+# import the api app from the sibling folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+# measures what the first requests after a deploy cost, with and without the startup warm-up.
+# every run is a fresh interpreter, so credentials, endpoints, resource classes and
+# connections all start cold. it talks to the deployed tables with your aws credentials
+
+def paths(site_id):
+   return [f"/sites/{site_id}/data?limit=100", f"/sites/{site_id}/anomalies", "/analytics/summary"]
+
+async def first_requests(mode, site_id):
+   # runs in the child: import, optional warm-up, then each path twice
+   started = time.perf_counter()
+   import app as api
+   result = {"mode": mode, "import_ms": (time.perf_counter() - started) * 1000, "warmup_ms": 0.0, "requests": {}}
+   if mode == "warm":
+       started = time.perf_counter()
+       await api.warm_up()
+       result["warmup_ms"] = (time.perf_counter() - started) * 1000
+   transport = httpx.ASGITransport(app=api.app)
+   async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+       for path in paths(site_id):
+           timings = []
+           for _ in range(2):
+               started = time.perf_counter()
+               response = await client.get(path)
+               timings.append((time.perf_counter() - started) * 1000)
+               response.raise_for_status()
+               # the second request should reach dynamodb too, not the response cache
+               api.response_cache._entries.clear()
+           result["requests"][path] = {"first_ms": timings[0], "second_ms": timings[1]}
+   return result
+
+def run_child(mode, site_id):
+   output = subprocess.run(
+       [sys.executable, os.path.abspath(__file__), "--child", mode, "--site", site_id],
+       check=True, capture_output=True, text=True
+   ).stdout
+   return json.loads(output.strip().splitlines()[-1])
+
+def median(values):
+   values = sorted(values)
+   return values[len(values) // 2]
+
+def main():
+   parser = argparse.ArgumentParser(description="First-request latency of the energy API with and without startup warm-up")
+   parser.add_argument("--site", default="SITE_001")
+   parser.add_argument("--runs", type=int, default=5, help="fresh processes per mode")
+   parser.add_argument("--child", choices=["cold", "warm"], help=argparse.SUPPRESS)
+   args = parser.parse_args()
+
+   if args.child:
+       print(json.dumps(asyncio.run(first_requests(args.child, args.site))))
+       return
+
+   print(f"median of {args.runs} fresh processes per mode, site {args.site}")
+   for mode in ("cold", "warm"):
+       runs = [run_child(mode, args.site) for _ in range(args.runs)]
+       print(f"\n{mode}: import {median([run['import_ms'] for run in runs]):.1f} ms, warm-up {median([run['warmup_ms'] for run in runs]):.1f} ms")
+       for path in paths(args.site):
+           first = median([run["requests"][path]["first_ms"] for run in runs])
+           second = median([run["requests"][path]["second_ms"] for run in runs])
+           print(f"  {path:<40} first {first:8.2f} ms   second {second:8.2f} ms")
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,69 @@
+import json
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+# import the api app from the sibling folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from app import DynamoJSONResponse
+
+ITEM_COUNT = 10000
+ROUNDS = 20
+
+def make_items(count):
+   # items shaped like what boto3 returns for the energy table
+   random.seed(42)
+   items = []
+   for i in range(count):
+       generated = Decimal(str(round(random.uniform(-10, 200), 2)))
+       consumed = Decimal(str(round(random.uniform(-10, 150), 2)))
+       items.append({
+           'site_id': f'SITE_00{i % 5 + 1}',
+           'timestamp': f'2025-06-08T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.123456Z',
+           'energy_generated_kwh': generated,
+           'energy_consumed_kwh': consumed,
+           'net_energy_kwh': generated - consumed,
+           'anomaly': generated < 0 or consumed < 0,
+           'processed_at': '2025-06-08T20:17:50.123456'
+       })
+   return items
+
+def fastapi_default(payload):
+   # what fastapi does for a returned dict: jsonable_encoder, then JSONResponse
+   return JSONResponse(jsonable_encoder(payload)).body
+
+def dynamo_response(payload):
+   return DynamoJSONResponse(payload).body
+
+def measure(render, payload):
+   render(payload)
+   timings = []
+   for _ in range(ROUNDS):
+       start = time.perf_counter()
+       body = render(payload)
+       timings.append(time.perf_counter() - start)
+   timings.sort()
+   return {'median_ms': timings[len(timings) // 2] * 1000, 'min_ms': timings[0] * 1000, 'bytes': len(body)}
+
+def main():
+   items = make_items(ITEM_COUNT)
+   payload = {'site_id': 'SITE_001', 'record_count': len(items), 'data': items}
+
+   baseline = measure(fastapi_default, payload)
+   fast = measure(dynamo_response, payload)
+
+   # both paths must describe the same numbers
+   assert json.loads(fastapi_default(payload)) == json.loads(dynamo_response(payload))
+
+   print(f"{ITEM_COUNT} items, {ROUNDS} rounds")
+   for name, result in (('jsonable_encoder + JSONResponse', baseline), ('DynamoJSONResponse', fast)):
+       print(f"  {name:<34} median {result['median_ms']:8.2f} ms   min {result['min_ms']:8.2f} ms   {result['bytes']:,} bytes")
+   print(f"  speedup {baseline['median_ms'] / fast['median_ms']:.1f}x")
+
+if __name__ == "__main__":
+   main()
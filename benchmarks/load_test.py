@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import httpx
+
+from fake_dynamodb import FakeDynamoDB
+
+# import the api app and the lambda from the sibling folders
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'api'))
+sys.path.insert(0, os.path.join(ROOT, 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import app as api
+import data_processor
+
+# readings are seeded back from this instant so runs are reproducible
+BASE_TIME = datetime(2025, 6, 8, 0, 0, 0)
+READING_INTERVAL = timedelta(minutes=5)
+
+def seed(fake, sites, readings_per_site, aggregates=True):
+   # same shape the lambda writes, including the stats table counters
+   random.seed(42)
+   table = fake.Table(api.table_name)
+   table.add_index(api.ANOMALY_INDEX_NAME, 'site_id', 'anomaly_at')
+   table.add_index(api.ANOMALY_DAY_INDEX_NAME, 'anomaly_day', 'timestamp')
+   stats = fake.Table(api.stats_table_name)
+   site_ids = [f"SITE_{i + 1:03d}" for i in range(sites)]
+   items = []
+   with table.batch_writer() as batch:
+       for site_id in site_ids:
+           for i in range(readings_per_site):
+               moment = BASE_TIME - READING_INTERVAL * (readings_per_site - i)
+               generated = round(random.uniform(-10, 200), 2) if random.random() < 0.05 else round(random.uniform(30, 220), 2)
+               consumed = round(random.uniform(-10, 10), 2) if random.random() < 0.05 else round(random.uniform(15, 165), 2)
+               item = {
+                   'site_id': site_id,
+                   'timestamp': moment.isoformat() + 'Z',
+                   'energy_generated_kwh': Decimal(str(generated)),
+                   'energy_consumed_kwh': Decimal(str(consumed)),
+                   'net_energy_kwh': Decimal(str(round(generated - consumed, 2))),
+                   'anomaly': generated < 0 or consumed < 0 or generated > 1000 or consumed > 1000,
+                   'processed_at': (moment + timedelta(seconds=30)).isoformat()
+               }
+               if item['anomaly']:
+                   item['anomaly_at'] = item['timestamp']
+                   item['anomaly_day'] = item['timestamp'][:10]
+               batch.put_item(Item=item)
+               items.append(item)
+   for site_id in site_ids:
+       stats.put_item(Item={'pk': 'site_versions', 'sk': site_id, 'version': 1, 'last_ingest_at': BASE_TIME.isoformat()})
+   if aggregates:
+       seed_aggregates(stats, items)
+   return site_ids
+
+def seed_aggregates(stats, items):
+   # what the lambda and scripts/backfill_aggregates.py leave behind: hourly rollups,
+   # histogram counters, per-site totals and a coverage marker spanning every reading
+   with stats.batch_writer() as batch:
+       for (site_id, hour), group in data_processor.summarize(items).items():
+           batch.put_item(Item=data_processor.rollup_item(site_id, hour, group))
+       for (pk, day), attributes in data_processor.histogram_counts(items).items():
+           batch.put_item(Item={'pk': pk, 'sk': day, **attributes})
+       for site_id in sorted(set(item['site_id'] for item in items)):
+           site_items = [item for item in items if item['site_id'] == site_id]
+           batch.put_item(Item={
+               'pk': 'totals',
+               'sk': site_id,
+               'readings': len(site_items),
+               'anomalies': sum(1 for item in site_items if item['anomaly']),
+               'total_generated': sum(item['energy_generated_kwh'] for item in site_items),
+               'total_consumed': sum(item['energy_consumed_kwh'] for item in site_items)
+           })
+       batch.put_item(Item={
+           'pk': 'meta',
+           'sk': 'coverage',
+           'rollups_since': min(item['timestamp'] for item in items),
+           'anomalies_since': min(item['timestamp'] for item in items),
+           'anomaly_days_since': min(item['timestamp'] for item in items),
+           'sketches_since': min(item['timestamp'] for item in items),
+           'histograms_since': min(item['timestamp'] for item in items),
+           'totals_complete': True
+       })
+
+def scenarios(site_ids):
+   # endpoint name -> function returning the path for the i-th request
+   day_start = (BASE_TIME - timedelta(days=1)).isoformat()
+   week_start = (BASE_TIME - timedelta(days=7)).isoformat()
+   end = BASE_TIME.isoformat()
+   pick = lambda i: site_ids[i % len(site_ids)]
+   return {
+       "sites": lambda i: "/sites",
+       "analytics_summary": lambda i: "/analytics/summary",
+       "site_data": lambda i: f"/sites/{pick(i)}/data?limit=100",
+       "site_data_range": lambda i: f"/sites/{pick(i)}/data?start_time={day_start}&end_time={end}&limit=1000",
+       "site_anomalies": lambda i: f"/sites/{pick(i)}/anomalies",
+       "fleet_anomalies": lambda i: f"/anomalies?start={day_start}&end={end}",
+       "histogram": lambda i: f"/analytics/histogram?metric=anomalies&bucket=5m&start={day_start}&end={end}",
+       "site_series": lambda i: f"/sites/{pick(i)}/series?start={week_start}&end={end}&resolution=1h",
+       "fleet_data": lambda i: f"/sites/data?site_ids={','.join(site_ids)}&start={day_start}&end={end}",
+   }
+
+def percentile(sorted_values, fraction):
+   if not sorted_values:
+       return 0.0
+   index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+   return sorted_values[index]
+
+async def drive(client, path_for, requests, concurrency):
+   # fire `requests` requests with at most `concurrency` in flight
+   latencies = []
+   errors = 0
+   total_bytes = 0
+   counter = iter(range(requests))
+
+   async def worker():
+       nonlocal errors, total_bytes
+       for i in counter:
+           start = time.perf_counter()
+           response = await client.get(path_for(i))
+           latencies.append(time.perf_counter() - start)
+           total_bytes += len(response.content)
+           if response.status_code >= 400:
+               errors += 1
+
+   started = time.perf_counter()
+   await asyncio.gather(*[worker() for _ in range(concurrency)])
+   return latencies, errors, total_bytes, time.perf_counter() - started
+
+async def run(args):
+   fake = FakeDynamoDB(latency=args.latency_ms / 1000, page_size=args.page_size)
+   site_ids = seed(fake, args.sites, args.readings, aggregates=not args.raw_only)
+   api.dynamodb = fake
+   api._tables.clear()
+   # the lifespan hook doesn't run under the ASGI client, so warm up and start the ingest poller by hand
+   await api.warm_up()
+   poller = asyncio.create_task(api.poll_cache_versions())
+   if args.no_cache:
+       api.response_cache.max_entries = 0
+
+   selected = scenarios(site_ids)
+   if args.endpoints:
+       selected = {name: selected[name] for name in args.endpoints.split(',')}
+
+   results = {}
+   transport = httpx.ASGITransport(app=api.app)
+   async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+       for name, path_for in selected.items():
+           # warm up, then start every endpoint from an empty cache
+           await drive(client, path_for, args.concurrency, args.concurrency)
+           api.response_cache._entries.clear()
+           fake.reset_calls()
+
+           latencies, errors, total_bytes, elapsed = await drive(client, path_for, args.requests, args.concurrency)
+           calls = dict(fake.calls)
+
+           # separate, shorter pass for memory since tracemalloc slows everything down
+           api.response_cache._entries.clear()
+           tracemalloc.start()
+           await drive(client, path_for, args.concurrency, args.concurrency)
+           _, peak = tracemalloc.get_traced_memory()
+           tracemalloc.stop()
+
+           latencies.sort()
+           results[name] = {
+               "requests": args.requests,
+               "errors": errors,
+               "requests_per_second": round(args.requests / elapsed, 1),
+               "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+               "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+               "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+               "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+               "avg_response_bytes": total_bytes // args.requests,
+               "peak_memory_kib": round(peak / 1024, 1),
+               "dynamodb_calls": calls,
+           }
+           print_result(name, results[name])
+   poller.cancel()
+   return results
+
+def print_result(name, result):
+   print(f"{name:<20} {result['requests_per_second']:>9.1f} req/s  p50 {result['p50_ms']:>8.2f} ms  "
+         f"p95 {result['p95_ms']:>8.2f} ms  p99 {result['p99_ms']:>8.2f} ms  peak {result['peak_memory_kib']:>9.1f} KiB  "
+         f"errors {result['errors']}")
+
+def compare(results, baseline_path):
+   # percent change against an earlier run, negative latency change is better
+   with open(baseline_path) as f:
+       baseline = json.load(f)["endpoints"]
+   print(f"\nChange vs {baseline_path}")
+   for name, result in results.items():
+       if name not in baseline:
+           continue
+       before = baseline[name]
+       deltas = []
+       for key in ("requests_per_second", "p50_ms", "p95_ms", "p99_ms", "peak_memory_kib"):
+           if before[key]:
+               deltas.append(f"{key} {(result[key] - before[key]) / before[key] * 100:+.1f}%")
+       print(f"{name:<20} " + "  ".join(deltas))
+
+def main():
+   parser = argparse.ArgumentParser(description="Load test the energy API against an in-process DynamoDB fake")
+   parser.add_argument("--sites", type=int, default=5)
+   parser.add_argument("--readings", type=int, default=2000, help="readings per site")
+   parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+   parser.add_argument("--concurrency", type=int, default=16)
+   parser.add_argument("--latency-ms", type=float, default=5.0, help="simulated round trip per DynamoDB call")
+   parser.add_argument("--page-size", type=int, default=1000, help="items per DynamoDB page")
+   parser.add_argument("--endpoints", help="comma separated subset of endpoints to run")
+   parser.add_argument("--no-cache", action="store_true", help="disable the API response cache")
+   parser.add_argument("--raw-only", action="store_true", help="leave out rollups and totals so every plan reads raw items")
+   parser.add_argument("--output", default="benchmark_results.json")
+   parser.add_argument("--compare", help="earlier results file to compare against")
+   args = parser.parse_args()
+
+   results = asyncio.run(run(args))
+   report = {
+       "created_at": datetime.utcnow().isoformat() + 'Z',
+       "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+       "endpoints": results,
+   }
+   with open(args.output, "w") as f:
+       json.dump(report, f, indent=2)
+   print(f"\nSaved results to {args.output}")
+   if args.compare:
+       compare(results, args.compare)
+
+if __name__ == "__main__":
+   main()
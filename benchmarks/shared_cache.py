@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import tempfile
+
+# compares response cache hit rates and dynamodb calls for one process, N workers with
+# their own caches and N workers sharing the memory-mapped cache. every worker is a
+# separate process with its own DynamoDB fake seeded the same way, like uvicorn workers
+# reading one table
+
+def cached_paths(site_ids):
+   # routes answered through the response cache
+   return [
+       "/sites",
+       "/analytics/summary",
+       *[f"/sites/{site_id}/data?limit=100" for site_id in site_ids],
+       *[f"/sites/{site_id}/anomalies" for site_id in site_ids],
+       *[f"/sites/{site_id}/series?resolution=1h" for site_id in site_ids],
+   ]
+
+def worker(worker_id, args, shared_path, start):
+   # the cache backend is picked when the app is imported, so set it first
+   if shared_path:
+       os.environ["ENERGY_API_SHARED_CACHE"] = shared_path
+   import httpx
+   import load_test
+   from fake_dynamodb import FakeDynamoDB
+   api = load_test.api
+
+   fake = FakeDynamoDB(latency=args.latency_ms / 1000)
+   site_ids = load_test.seed(fake, args.sites, args.readings)
+   api.dynamodb = fake
+   api._tables.clear()
+
+   async def run(requests):
+       await api.warm_up()
+       fake.reset_calls()
+       paths = cached_paths(site_ids)
+       rng = random.Random(worker_id)
+       transport = httpx.ASGITransport(app=api.app)
+       async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+           # all workers start together, like a load balancer spreading one stream of requests
+           start.wait()
+           for _ in range(requests):
+               response = await client.get(rng.choice(paths))
+               response.raise_for_status()
+       return sum(fake.calls.values())
+
+   requests = args.requests * (args.workers if start.parties == 1 else 1)
+   calls = asyncio.run(run(requests))
+   stats = api.response_cache.stats()
+   return {"calls": calls, "lookups": stats["hits"] + stats["misses"] + stats["coalesced"] + stats["shared_hits"], "hits": stats["hits"] + stats["coalesced"], "shared_hits": stats["shared_hits"]}
+
+def run_mode(args, workers, shared_path):
+   context = multiprocessing.get_context("spawn")
+   with context.Manager() as manager:
+       start = manager.Barrier(workers)
+       with context.Pool(workers) as pool:
+           results = pool.starmap(worker, [(i, args, shared_path, start) for i in range(workers)])
+   lookups = sum(result["lookups"] for result in results)
+   hits = sum(result["hits"] + result["shared_hits"] for result in results)
+   return {
+       "hit_rate": hits / lookups if lookups else 0,
+       "shared_hits": sum(result["shared_hits"] for result in results),
+       "dynamodb_calls": sum(result["calls"] for result in results),
+   }
+
+def main():
+   parser = argparse.ArgumentParser(description="Response cache hit rate across uvicorn-style worker processes")
+   parser.add_argument("--workers", type=int, default=4)
+   parser.add_argument("--sites", type=int, default=5)
+   parser.add_argument("--readings", type=int, default=500, help="readings per site")
+   parser.add_argument("--requests", type=int, default=400, help="requests per worker")
+   parser.add_argument("--latency-ms", type=float, default=2.0, help="simulated round trip per DynamoDB call")
+   args = parser.parse_args()
+
+   shared_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+   with tempfile.TemporaryDirectory(dir=shared_dir) as directory:
+       modes = (
+           ("1 process", 1, None),
+           (f"{args.workers} workers, own caches", args.workers, None),
+           (f"{args.workers} workers, shared cache", args.workers, os.path.join(directory, "energy-api-cache")),
+       )
+       print(f"{args.requests * args.workers} requests over {len(cached_paths(['x'] * args.sites))} cached routes")
+       for name, workers, shared_path in modes:
+           result = run_mode(args, workers, shared_path)
+           print(f"  {name:<30} hit rate {result['hit_rate']:6.1%}   shared hits {result['shared_hits']:>5}   dynamodb calls {result['dynamodb_calls']:>6}")
+
+if __name__ == "__main__":
+   main()
@@ -51,11 +51,77 @@ resource "aws_dynamodb_table" "energy_data" {
     type ="S"
   }
 
+  attribute {
+    name = "anomaly_at"
+    type = "S"
+  }
+
+  attribute {
+    name = "anomaly_day"
+    type = "S"
+  }
+
+  attribute {
+    name = "processed_day"
+    type = "S"
+  }
+
+  attribute {
+    name = "processed_at"
+    type = "S"
+  }
+
+  # sparse index -- only anomalies carry anomaly_at
+  global_secondary_index {
+    name            = "site-anomalies-index"
+    hash_key        = "site_id"
+    range_key       = "anomaly_at"
+    projection_type = "ALL"
+  }
+
+  # anomalies of every site in time order, one partition per utc day, for /anomalies
+  global_secondary_index {
+    name            = "anomaly-day-index"
+    hash_key        = "anomaly_day"
+    range_key       = "timestamp"
+    projection_type = "ALL"
+  }
+
+  # readings in processing order, one partition per utc day, for the /changes feed
+  global_secondary_index {
+    name            = "processed-day-index"
+    hash_key        = "processed_day"
+    range_key       = "processed_at"
+    projection_type = "ALL"
+  }
+
   tags = {
     Name ="EnergyDataTable"
   }
 }
 
+# per-site counters and aggregates maintained by the lambda on ingest
+resource "aws_dynamodb_table" "energy_stats" {
+  name           = "${var.project_name}-energy-stats"
+  billing_mode   ="PAY_PER_REQUEST"
+  hash_key       ="pk"
+  range_key      = "sk"
+
+  attribute {
+    name ="pk"
+    type = "S"
+  }
+
+  attribute {
+    name = "sk"
+    type ="S"
+  }
+
+  tags = {
+    Name ="EnergyStatsTable"
+  }
+}
+
 resource "aws_iam_role" "lambda_role" {
   name = "${var.project_name}-lambda-role"
 
@@ -105,6 +171,15 @@ resource "aws_iam_role_policy" "lambda_policy" {
           "dynamodb:Scan"
         ]
         Resource =aws_dynamodb_table.energy_data.arn
+      },
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:UpdateItem",
+          "dynamodb:GetItem",
+          "dynamodb:Query"
+        ]
+        Resource =aws_dynamodb_table.energy_stats.arn
       }
     ]
   })
@@ -6,6 +6,10 @@ output "dynamodb_table_name" {
   value = aws_dynamodb_table.energy_data.name
 }
 
+output "dynamodb_stats_table_name" {
+  value = aws_dynamodb_table.energy_stats.name
+}
+
 output "lambda_function_name" {
   value = aws_lambda_function.data_processor.function_name
 }
\ No newline at end of file
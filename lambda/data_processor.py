@@ -1,7 +1,8 @@
 import json
+import math
 import boto3
 import urllib.parse
-from datetime import datetime
+from datetime import datetime, timedelta
 from decimal import Decimal
 import logging
 
@@ -12,6 +13,8 @@ logger.setLevel(logging.INFO)
 # aws clients
 s3_client =boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
+table_name ='energy-data-analytics-energy-data'
+stats_table_name = 'energy-data-analytics-energy-stats'
 
 def convert_float_to_decimal(obj):
     # dynamodb needs decimal instead of float
@@ -21,6 +24,346 @@ def convert_float_to_decimal(obj):
         return {k: convert_float_to_decimal(v) for k, v in obj.items()}
     return obj
 
+# numeric attributes we keep rollups for
+AGGREGATE_METRICS = ['energy_generated_kwh', 'energy_consumed_kwh', 'net_energy_kwh']
+
+# quantile sketches kept per site per hour: log-spaced buckets (ddsketch style), so any
+# quantile is within SKETCH_ACCURACY relative error and sketches merge by adding counts.
+# the api decodes the same layout in app.py
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# values closer to zero than this share one bucket
+SKETCH_MIN_VALUE = 0.001
+SKETCH_FORMAT = 1
+# concurrent invocations writing the same hour retry this many times
+SKETCH_RETRIES = 5
+
+def new_sketch():
+    return {'zero': 0, 'pos': {}, 'neg': {}}
+
+def sketch_add(sketch, value):
+    value = float(value)
+    if abs(value) < SKETCH_MIN_VALUE:
+        sketch['zero'] += 1
+        return
+    store = sketch['pos'] if value > 0 else sketch['neg']
+    index = math.ceil(math.log(abs(value), SKETCH_GAMMA))
+    store[index] = store.get(index, 0) + 1
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+def read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+def encode_sketch(sketch):
+    # format byte, zero count, then per store (positive, negative): bucket count and
+    # (zigzag index delta, count) varint pairs -- a few bytes per occupied bucket
+    out = bytearray([SKETCH_FORMAT])
+    write_varint(out, sketch['zero'])
+    for store in (sketch['pos'], sketch['neg']):
+        write_varint(out, len(store))
+        previous = 0
+        for index in sorted(store):
+            delta = index - previous
+            write_varint(out, delta * 2 if delta >= 0 else -delta * 2 - 1)
+            write_varint(out, store[index])
+            previous = index
+    return bytes(out)
+
+def decode_sketch(data):
+    sketch = new_sketch()
+    sketch['zero'], pos = read_varint(data, 1)
+    for name in ('pos', 'neg'):
+        size, pos = read_varint(data, pos)
+        index = 0
+        for _ in range(size):
+            delta, pos = read_varint(data, pos)
+            index += delta // 2 if delta % 2 == 0 else -(delta + 1) // 2
+            sketch[name][index], pos = read_varint(data, pos)
+    return sketch
+
+def hour_bucket(timestamp):
+    # '2025-06-08T20:17:49.123Z' -> '2025-06-08T20:00:00'
+    return timestamp[:13] + ':00:00'
+
+def summarize(items):
+    # partial aggregates for one batch of items, keyed by (site, hour)
+    groups = {}
+    for item in items:
+        key = (item['site_id'], hour_bucket(item['timestamp']))
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {'readings': 0, 'anomalies': 0, 'sum': {}, 'min': {}, 'max': {}, 'values': {}}
+        group['readings'] += 1
+        if item['anomaly']:
+            group['anomalies'] += 1
+        for metric in AGGREGATE_METRICS:
+            value = item[metric]
+            group['sum'][metric] = group['sum'].get(metric, 0) + value
+            group['min'][metric] = min(group['min'].get(metric, value), value)
+            group['max'][metric] = max(group['max'].get(metric, value), value)
+            group['values'].setdefault(metric, []).append(value)
+    return groups
+
+def rollup_item(site_id, hour, group):
+    # the whole rollup for an hour, for writers that rebuild it from scratch
+    item = {'pk': f'rollup#1h#{site_id}', 'sk': hour, 'readings': group['readings'], 'anomalies': group['anomalies'], 'sketch_count': group['readings']}
+    for metric in AGGREGATE_METRICS:
+        for kind in ('sum', 'min', 'max'):
+            item[f'{metric}_{kind}'] = group[kind][metric]
+        sketch = new_sketch()
+        for value in group['values'][metric]:
+            sketch_add(sketch, value)
+        item[f'{metric}_sketch'] = encode_sketch(sketch)
+    return item
+
+def update_rollup(stats_table, claim, site_id, hour, group):
+    # counts and sums are added atomically together with the claim step, extremes and
+    # sketches follow as their own steps so a retry never adds the counts again
+    key = {'pk': f'rollup#1h#{site_id}', 'sk': hour}
+    step = f'rollup#{site_id}#{hour}'
+    add = ['readings :readings', 'anomalies :anomalies']
+    values = {':readings': group['readings'], ':anomalies': group['anomalies']}
+    for i, metric in enumerate(AGGREGATE_METRICS):
+        add.append(f'{metric}_sum :sum{i}')
+        values[f':sum{i}'] = group['sum'][metric]
+    claim.apply(f'{step}#add', Key=key, UpdateExpression='ADD ' + ', '.join(add), ExpressionAttributeValues=values)
+    claim.run(f'{step}#extremes', update_extremes, stats_table, key, group)
+    claim.run(f'{step}#sketches', update_sketches, stats_table, key, group)
+
+def update_extremes(stats_table, key, group):
+    # conditional, so repeating them is harmless and a lower max / higher min never wins.
+    # only written when they move past the stored value
+    stored = stats_table.get_item(Key=key, ConsistentRead=True).get('Item', {})
+    for metric in AGGREGATE_METRICS:
+        for extreme, beats in (('min', '>'), ('max', '<')):
+            name = f'{metric}_{extreme}'
+            value = group[extreme][metric]
+            current = stored.get(name)
+            if current is not None and not (value < current if extreme == 'min' else value > current):
+                continue
+            try:
+                stats_table.update_item(
+                    Key=key,
+                    UpdateExpression=f'SET {name} = :value',
+                    ConditionExpression=f'attribute_not_exists({name}) OR {name} {beats} :value',
+                    ExpressionAttributeValues={':value': value}
+                )
+            except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+                # another invocation already wrote a better value
+                pass
+
+def update_sketches(stats_table, key, group):
+    # read-modify-write of the binary sketches, guarded by the number of values they hold
+    # so a concurrent invocation makes us re-read and retry instead of being overwritten
+    stored = stats_table.get_item(Key=key, ConsistentRead=True).get('Item', {})
+    for _ in range(SKETCH_RETRIES):
+        count = stored.get('sketch_count', 0)
+        sets = ['sketch_count = :count']
+        values = {':count': count + group['readings'], ':expected': count}
+        for i, metric in enumerate(AGGREGATE_METRICS):
+            current = stored.get(f'{metric}_sketch')
+            sketch = decode_sketch(bytes(current)) if current is not None else new_sketch()
+            for value in group['values'][metric]:
+                sketch_add(sketch, value)
+            sets.append(f'{metric}_sketch = :sketch{i}')
+            values[f':sketch{i}'] = encode_sketch(sketch)
+        try:
+            stats_table.update_item(
+                Key=key,
+                UpdateExpression='SET ' + ', '.join(sets),
+                ConditionExpression='attribute_not_exists(sketch_count) OR sketch_count = :expected',
+                ExpressionAttributeValues=values
+            )
+            return
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            stored = stats_table.get_item(Key=key, ConsistentRead=True).get('Item', {})
+    # fail the step, otherwise the sketch would silently miss these values for good
+    raise RuntimeError(f"Gave up updating sketches for {key['pk']} {key['sk']}")
+
+def update_site_totals(claim, site_id, groups):
+    # running all-time totals per site, the api summary reads these instead of scanning
+    readings = sum(group['readings'] for group in groups)
+    anomalies = sum(group['anomalies'] for group in groups)
+    claim.apply(
+        f'totals#{site_id}',
+        Key={'pk': 'totals', 'sk': site_id},
+        UpdateExpression='ADD readings :readings, anomalies :anomalies, total_generated :generated, total_consumed :consumed',
+        ExpressionAttributeValues={
+            ':readings': readings,
+            ':anomalies': anomalies,
+            ':generated': sum(group['sum']['energy_generated_kwh'] for group in groups),
+            ':consumed': sum(group['sum']['energy_consumed_kwh'] for group in groups)
+        }
+    )
+
+# reading and anomaly counts per 5-minute slot, one item per site per utc day plus one for
+# the whole fleet. slots are top-level attributes (readings_HHMM, anomalies_HHMM) so ingest
+# can ADD to them atomically, the api sums them into 5m, 1h or 1d histogram buckets
+HISTOGRAM_SLOT_MINUTES = 5
+HISTOGRAM_FLEET_KEY = 'histogram#fleet'
+# counters per update, keeps big batches under the 4 KB expression limit
+HISTOGRAM_UPDATE_ATTRIBUTES = 50
+
+def histogram_slot(timestamp):
+    # '2025-06-08T20:17:49.123Z' -> ('2025-06-08', '2015')
+    minute = int(timestamp[14:16]) // HISTOGRAM_SLOT_MINUTES * HISTOGRAM_SLOT_MINUTES
+    return timestamp[:10], f'{timestamp[11:13]}{minute:02d}'
+
+def histogram_counts(items):
+    # counter attributes to add per (histogram key, day) for a batch of items
+    counts = {}
+    for item in items:
+        day, slot = histogram_slot(item['timestamp'])
+        for pk in (f"histogram#site#{item['site_id']}", HISTOGRAM_FLEET_KEY):
+            attributes = counts.setdefault((pk, day), {})
+            names = ['readings', f'readings_{slot}']
+            if item['anomaly']:
+                names += ['anomalies', f'anomalies_{slot}']
+            for name in names:
+                attributes[name] = attributes.get(name, 0) + 1
+    return counts
+
+def update_histograms(claim, items):
+    for (pk, day), attributes in histogram_counts(items).items():
+        names = sorted(attributes)
+        for offset in range(0, len(names), HISTOGRAM_UPDATE_ATTRIBUTES):
+            chunk = names[offset:offset + HISTOGRAM_UPDATE_ATTRIBUTES]
+            claim.apply(
+                f'{pk}#{day}#{offset}',
+                Key={'pk': pk, 'sk': day},
+                UpdateExpression='ADD ' + ', '.join(f'{name} :v{i}' for i, name in enumerate(chunk)),
+                ExpressionAttributeValues={f':v{i}': attributes[name] for i, name in enumerate(chunk)}
+            )
+
+def mark_coverage(stats_table, since):
+    # earliest reading the aggregates have seen -- the api only trusts rollup hours,
+    # sketches and the anomaly indexes from here on (scripts/backfill_aggregates.py moves it back)
+    stats_table.update_item(
+        Key={'pk': 'meta', 'sk': 'coverage'},
+        UpdateExpression='SET rollups_since = if_not_exists(rollups_since, :since), anomalies_since = if_not_exists(anomalies_since, :since), '
+                         'anomaly_days_since = if_not_exists(anomaly_days_since, :since), sketches_since = if_not_exists(sketches_since, :since), '
+                         'histograms_since = if_not_exists(histograms_since, :since)',
+        ExpressionAttributeValues={':since': since}
+    )
+
+def update_aggregates(items, claim):
+    # hourly rollups, per-site totals and histogram counters for a batch of newly stored
+    # items, each update run through the file's claim so none is applied twice
+    if not items:
+        return
+    stats_table = dynamodb.Table(stats_table_name)
+    groups = summarize(items)
+    by_site = {}
+    for (site_id, hour), group in groups.items():
+        update_rollup(stats_table, claim, site_id, hour, group)
+        by_site.setdefault(site_id, []).append(group)
+    for site_id, site_groups in by_site.items():
+        update_site_totals(claim, site_id, site_groups)
+    update_histograms(claim, items)
+    mark_coverage(stats_table, min(item['timestamp'] for item in items))
+
+class AggregateUpdateError(Exception):
+    # aggregates for a claimed file failed, raised so lambda retries the event
+    pass
+
+# a claim older than this belongs to an invocation that timed out (the function's timeout is 30s)
+CLAIM_LEASE_SECONDS = 60
+
+class FileClaim:
+    # marker item for one version of an s3 object. the aggregates use ADD, so each
+    # update is recorded as a step once applied, and duplicate deliveries, reruns and
+    # retries after a failure never apply a step twice. ADD steps are written in the
+    # same transaction as their record, the rest (conditional) right after they succeed
+
+    def __init__(self, bucket, key, etag):
+        self.stats_table = dynamodb.Table(stats_table_name)
+        self.key = {'pk': 'ingested', 'sk': f'{bucket}/{key}/{etag}'}
+        self.done = set()
+
+    def acquire(self):
+        # free, failed, or held by an invocation that must have timed out by now
+        now = datetime.utcnow()
+        try:
+            stored = self.stats_table.update_item(
+                Key=self.key,
+                UpdateExpression='SET #status = :claimed, claimed_at = :now',
+                ConditionExpression='attribute_not_exists(sk) OR #status = :failed OR (#status = :claimed AND claimed_at < :expired)',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':claimed': 'claimed',
+                    ':failed': 'failed',
+                    ':now': now.isoformat(),
+                    ':expired': (now - timedelta(seconds=CLAIM_LEASE_SECONDS)).isoformat()
+                },
+                ReturnValues='ALL_NEW'
+            )['Attributes']
+        except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        self.done = set(stored.get('steps', []))
+        return True
+
+    def apply(self, step, **update):
+        # one update of the stats table and its step record, all or nothing. the record
+        # is conditional too, so a step can't be added twice even by two invocations
+        if step in self.done:
+            return
+        client = dynamodb.meta.client
+        try:
+            client.transact_write_items(TransactItems=[
+                {'Update': {'TableName': stats_table_name, **update}},
+                {'Update': {
+                    'TableName': stats_table_name,
+                    'Key': self.key,
+                    'UpdateExpression': 'ADD steps :step',
+                    'ConditionExpression': 'NOT contains(steps, :name)',
+                    'ExpressionAttributeValues': {':step': {step}, ':name': step}
+                }}
+            ])
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = [reason.get('Code') for reason in e.response.get('CancellationReasons', [])]
+            if reasons[1:2] != ['ConditionalCheckFailed']:
+                raise
+            # another invocation applied it first
+        self.done.add(step)
+
+    def run(self, step, update, *args, **kwargs):
+        if step in self.done:
+            return
+        update(*args, **kwargs)
+        self.stats_table.update_item(Key=self.key, UpdateExpression='ADD steps :step', ExpressionAttributeValues={':step': {step}})
+        self.done.add(step)
+
+    def finish(self, status):
+        self.stats_table.update_item(
+            Key=self.key,
+            UpdateExpression='SET #status = :status',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':status': status}
+        )
+
+def bump_site_versions(site_ids):
+    # one counter per site, the api polls these to drop stale cache entries
+    stats_table = dynamodb.Table(stats_table_name)
+    now = datetime.utcnow().isoformat()
+    for site_id in site_ids:
+        stats_table.update_item(
+            Key={'pk': 'site_versions', 'sk': site_id},
+            UpdateExpression='ADD version :one SET last_ingest_at = :now',
+            ExpressionAttributeValues={':one': 1, ':now': now}
+        )
+
 def lambda_handler(event, context):
     try:
         # get bucket and file info from s3 event
@@ -35,11 +378,12 @@ def lambda_handler(event, context):
         data = json.loads(content)
         
         # connect to dynamodb table
-        table_name ='energy-data-analytics-energy-data'
         table = dynamodb.Table(table_name)
         
         processed_count =0
         anomaly_count =0
+        # items stored from this file, for the aggregates
+        stored_items = []
         
         # processes each record in the file
         for record in data:
@@ -67,10 +411,33 @@ def lambda_handler(event, context):
                 'anomaly': is_anomaly,
                 'processed_at': datetime.utcnow().isoformat()
             })
+            # day bucket of the processed-day index the api change feed reads
+            item['processed_day'] = item['processed_at'][:10]
+            # only anomalies get these attributes, which keeps the anomaly indexes sparse
+            if is_anomaly:
+                item['anomaly_at'] = record['timestamp']
+                # day partition of the fleet-wide anomaly index
+                item['anomaly_day'] = record['timestamp'][:10]
             
             # save to database
             table.put_item(Item=item)
             processed_count +=1
+            stored_items.append(item)
+        
+        # readings are plain puts and safe to repeat, the aggregates are not
+        claim = FileClaim(bucket, key, response['ETag'].strip('"'))
+        if claim.acquire():
+            try:
+                update_aggregates(stored_items, claim)
+            except Exception as e:
+                # the steps applied so far stay recorded, the retry carries on from there
+                claim.finish('failed')
+                raise AggregateUpdateError(str(e)) from e
+            claim.finish('applied')
+        else:
+            logger.info(f"Aggregates for {key} were already applied, skipping them")
+        # let api caches know these sites changed
+        bump_site_versions(set(item['site_id'] for item in stored_items))
         
         logger.info(f" Processed {processed_count} records,found {anomaly_count} anomalies")
         
@@ -83,6 +450,10 @@ def lambda_handler(event, context):
             })
         }
         
+    except AggregateUpdateError as e:
+        # fail the invocation instead of answering 500, so lambda retries the file
+        logger.exception(f"Error updating aggregates: {str(e)}")
+        raise
     except Exception as e:
         # something went wrong
         logger.error(f"Error processing file: {str(e)}")
@@ -0,0 +1,76 @@
+import os
+import sys
+
+# the lambda module builds its clients on import and expects a region from the environment
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+import data_processor
+
+# rebuilds the aggregates the lambda maintains from the readings already in the table.
+# run it once after deploying the aggregate tables, with the data generator stopped --
+# it overwrites rollups and totals, so readings ingested while it runs can be lost
+
+def scan_readings(table):
+   # every reading in the table, page by page
+   kwargs = {}
+   while True:
+       response = table.scan(**kwargs)
+       yield from response['Items']
+       if 'LastEvaluatedKey' not in response:
+           return
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def main():
+   table = data_processor.dynamodb.Table(data_processor.table_name)
+   stats_table = data_processor.dynamodb.Table(data_processor.stats_table_name)
+
+   items = []
+   indexed = 0
+   for item in scan_readings(table):
+       items.append(item)
+       # older readings were stored before the index attributes existed
+       updates = {}
+       if item.get('anomaly', False) and 'anomaly_at' not in item:
+           updates['anomaly_at'] = item['timestamp']
+       if item.get('anomaly', False) and 'anomaly_day' not in item:
+           updates['anomaly_day'] = item['timestamp'][:10]
+       if 'processed_day' not in item and 'processed_at' in item:
+           updates['processed_day'] = item['processed_at'][:10]
+       if updates:
+           table.update_item(
+               Key={'site_id': item['site_id'], 'timestamp': item['timestamp']},
+               UpdateExpression='SET ' + ', '.join(f'{name} = :{name}' for name in updates),
+               ExpressionAttributeValues={f':{name}': value for name, value in updates.items()}
+           )
+           indexed += 1
+   print(f"Read {len(items)} readings, indexed {indexed} older ones")
+   if not items:
+       return
+
+   groups = data_processor.summarize(items)
+   totals = {}
+   with stats_table.batch_writer() as batch:
+       for (site_id, hour), group in groups.items():
+           batch.put_item(Item=data_processor.rollup_item(site_id, hour, group))
+
+           site = totals.setdefault(site_id, {'pk': 'totals', 'sk': site_id, 'readings': 0, 'anomalies': 0, 'total_generated': 0, 'total_consumed': 0})
+           site['readings'] += group['readings']
+           site['anomalies'] += group['anomalies']
+           site['total_generated'] += group['sum']['energy_generated_kwh']
+           site['total_consumed'] += group['sum']['energy_consumed_kwh']
+       for site in totals.values():
+           batch.put_item(Item=site)
+       histograms = data_processor.histogram_counts(items)
+       for (pk, day), attributes in histograms.items():
+           batch.put_item(Item={'pk': pk, 'sk': day, **attributes})
+   print(f"Wrote {len(groups)} hourly rollups, {len(histograms)} daily histogram counters and totals for {len(totals)} sites")
+
+   # everything in the table is now covered
+   stats_table.update_item(
+       Key={'pk': 'meta', 'sk': 'coverage'},
+       UpdateExpression='SET rollups_since = :since, anomalies_since = :since, anomaly_days_since = :since, sketches_since = :since, histograms_since = :since, totals_complete = :complete',
+       ExpressionAttributeValues={':since': min(item['timestamp'] for item in items), ':complete': True}
+   )
+
+if __name__ == "__main__":
+   main()
@@ -1,52 +1,313 @@
 import streamlit as st
 import boto3
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-from datetime import datetime
+import io
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+# parquet downloads are offered only when pyarrow is installed
+try:
+   import pyarrow as pa
+   import pyarrow.parquet as pq
+except ImportError:
+   pa = None
 
 # set up the page
 st.set_page_config (page_title= "Renewable Energy Dashboard", page_icon= "⚡", layout="wide")
 
+TABLE_NAME = 'energy-data-analytics-energy-data'
+# readings by processing time, used to fetch only what arrived since the last load
+CHANGES_INDEX_NAME = 'processed-day-index'
+# loaded data is served as is for this long before dynamodb is asked for new readings
+REFRESH_SECONDS = 60
+# everything is reloaded this often so deleted or rewritten readings don't linger
+FULL_RELOAD_SECONDS = 6 * 60 * 60
+# readings processed more recently than this may still be missing from the index
+SETTLE_SECONDS = 10
+# parallel scan segments for a full load, each one its own paginated scan
+SCAN_SEGMENTS = 8
+NUMERIC_COLUMNS = ['energy_generated_kwh', 'energy_consumed_kwh', 'net_energy_kwh']
+# only the attributes the dashboard shows are read. timestamp is a reserved word,
+# so every name goes through a placeholder
+LOAD_COLUMNS = ['site_id', 'timestamp', *NUMERIC_COLUMNS, 'anomaly']
+PROJECTION = {
+   "ProjectionExpression": ", ".join(f"#c{i}" for i in range(len(LOAD_COLUMNS))),
+   "ExpressionAttributeNames": {f"#c{i}": column for i, column in enumerate(LOAD_COLUMNS)}
+}
+
+# rows per page of the raw data table
+RAW_PAGE_ROWS = 500
+# downloads are written this many rows at a time
+EXPORT_CHUNK_ROWS = 50000
+
 @st.cache_resource
 def init_dynamodb():
-   # connect to aws database
-   return boto3.resource('dynamodb', region_name='us-east-1')
+   # connect to aws database. the low-level client is thread-safe and returns raw
+   # attribute values, which go straight into typed columns
+   return boto3.client('dynamodb', region_name='us-east-1')
 
-def load_data():
-   # get data from database
-   dynamodb =init_dynamodb()
-   table_name ='energy-data-analytics-energy-data'
-   table = dynamodb.Table(table_name)
-   
+def number(value):
+   # missing or unparseable energy values count as 0
+   try:
+       return float(value['N'])
+   except (TypeError, KeyError, ValueError):
+       return 0.0
+
+class ColumnPages:
+   # typed column arrays filled one page at a time, so a load never holds every
+   # reading as a dict. items are raw attribute values from the client
+
+   def __init__(self):
+       self.site_ids = []
+       self.timestamps = []
+       self.numbers = {column: array('d') for column in NUMERIC_COLUMNS}
+       self.anomalies = array('b')
+
+   def __len__(self):
+       return len(self.site_ids)
+
+   def add(self, items):
+       for item in items:
+           self.site_ids.append(item['site_id']['S'])
+           self.timestamps.append(item.get('timestamp', {}).get('S'))
+           for column, values in self.numbers.items():
+               values.append(number(item.get(column)))
+           self.anomalies.append(item.get('anomaly', {}).get('BOOL', False))
+
+   def frame(self):
+       df = pd.DataFrame({
+           'site_id': self.site_ids,
+           # readings are stored in utc, with or without fractional seconds and a Z suffix
+           'timestamp': pd.to_datetime(pd.Series(self.timestamps, dtype=object), errors='coerce', utc=True, format='ISO8601'),
+           **{column: np.frombuffer(values, dtype=np.float64) for column, values in self.numbers.items()},
+           'anomaly': np.frombuffer(self.anomalies, dtype=np.int8).astype(bool)
+       })
+       # remove rows with bad timestamps
+       return df.dropna(subset=['timestamp']).reset_index(drop=True)
+
+def scan_segment(client, segment, pages):
+   # one segment of the parallel scan, followed to its last page
+   kwargs = {"TableName": TABLE_NAME, "Segment": segment, "TotalSegments": SCAN_SEGMENTS, **PROJECTION}
+   requests = 0
+   while True:
+       response = client.scan(**kwargs)
+       requests += 1
+       pages.add(response['Items'])
+       if 'LastEvaluatedKey' not in response:
+           return requests
+       kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def scan_table(on_progress):
+   # every reading, read by SCAN_SEGMENTS threads at once. streamlit calls only work
+   # on the script thread, so it polls the segments and reports the rows read so far
+   client = init_dynamodb()
+   segments = [ColumnPages() for _ in range(SCAN_SEGMENTS)]
+   with ThreadPoolExecutor(max_workers=SCAN_SEGMENTS) as pool:
+       futures = [pool.submit(scan_segment, client, segment, pages) for segment, pages in enumerate(segments)]
+       pending = futures
+       while pending:
+           _, pending = wait(pending, timeout=0.25)
+           on_progress(sum(len(pages) for pages in segments))
+       requests = sum(future.result() for future in futures)
+   return pd.concat([pages.frame() for pages in segments], ignore_index=True), requests
+
+def query_changes(since, until):
+   # readings processed between two watermarks, one query per processed day
+   client = init_dynamodb()
+   pages = ColumnPages()
+   queries = 0
+   day = datetime.fromisoformat(since).date()
+   # one day ahead in case the lambda's clock is ahead of ours around midnight
+   last_day = datetime.utcnow().date() + timedelta(days=1)
+   while day <= last_day:
+       kwargs = {
+           "TableName": TABLE_NAME,
+           "IndexName": CHANGES_INDEX_NAME,
+           "KeyConditionExpression": "#day = :day AND #at BETWEEN :since AND :until",
+           "ExpressionAttributeValues": {":day": {"S": day.isoformat()}, ":since": {"S": since}, ":until": {"S": until}},
+           "ProjectionExpression": PROJECTION["ProjectionExpression"],
+           "ExpressionAttributeNames": {**PROJECTION["ExpressionAttributeNames"], "#day": "processed_day", "#at": "processed_at"}
+       }
+       while True:
+           response = client.query(**kwargs)
+           queries += 1
+           pages.add(response['Items'])
+           if 'LastEvaluatedKey' not in response:
+               break
+           kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+       day += timedelta(days=1)
+   return pages.frame(), queries
+
+def estimated_readings():
+   # dynamodb's item count, refreshed about every six hours, good enough for a progress bar
    try:
-       response = table.scan()
-       return pd.DataFrame(response['Items'])
-   except Exception as e:
-       st.error(f" Error loading data:{str(e)}")
-       return pd.DataFrame()
+       return init_dynamodb().describe_table(TableName=TABLE_NAME)['Table']['ItemCount']
+   except Exception:
+       return 0
+
+class DataStore:
+   # loaded readings shared by every session and rerun, plus the processed_at
+   # watermark they are complete up to. reruns inside REFRESH_SECONDS read nothing,
+   # later ones only query readings processed after the watermark
+
+   def __init__(self):
+       self.lock = threading.Lock()
+       self.df = None
+       self.watermark = None
+       self.checked_at = 0
+       # bumped whenever df changes, so derived results know when they are stale
+       self.version = 0
+       self.stats = {"full_loads": 0, "refreshes": 0, "new_readings": 0, "requests": 0}
+
+   def full_load(self, on_progress):
+       # stored processed_at values have no Z suffix, keep the watermark in the same form
+       started = (datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)).isoformat()
+       df, requests = scan_table(on_progress)
+       self.stats["requests"] += requests
+       self.df = df
+       self.version += 1
+       self.watermark = started
+       self.checked_at = time.time()
+       self.stats["full_loads"] += 1
+
+   def refresh(self):
+       # append readings processed since the watermark. the window overlaps the
+       # previous one at the edges, so rows are de-duplicated by key, newest wins
+       until = (datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)).isoformat()
+       self.checked_at = time.time()
+       if until <= self.watermark:
+           return
+       new, queries = query_changes(self.watermark, until)
+       self.stats["requests"] += queries
+       self.stats["refreshes"] += 1
+       self.watermark = until
+       if new.empty:
+           return
+       self.stats["new_readings"] += len(new)
+       df = pd.concat([self.df, new], ignore_index=True) if not self.df.empty else new
+       self.df = df.drop_duplicates(subset=['site_id', 'timestamp'], keep='last').reset_index(drop=True)
+       self.version += 1
+
+@st.cache_resource(ttl=FULL_RELOAD_SECONDS)
+def data_store():
+   # one store per server process, dropped for a full reload once the ttl passes
+   return DataStore()
+
+def load_data(force_refresh=False):
+   # get data from the shared store, asking the database only when it is stale.
+   # the returned frame is shared, so callers filter it into new frames and never edit it
+   store = data_store()
+   with store.lock:
+       if store.df is None:
+           expected = estimated_readings()
+           progress = st.progress(0.0, text="Loading data...")
+
+           def on_progress(rows):
+               fraction = min(rows / expected, 1.0) if expected else 0.0
+               progress.progress(fraction, text=f"Loaded {rows:,} of about {expected:,} readings" if expected else f"Loaded {rows:,} readings")
+
+           try:
+               store.full_load(on_progress)
+           except Exception as e:
+               st.error(f" Error loading data:{str(e)}")
+               return pd.DataFrame(), store
+           finally:
+               progress.empty()
+       elif force_refresh or time.time() - store.checked_at >= REFRESH_SECONDS:
+           try:
+               store.refresh()
+           except Exception as e:
+               # keep showing what we have, the next stale rerun tries again
+               st.warning(f"Could not check for new data, showing cached data: {str(e)}")
+       return store.df, store
+
+def export_chunks(df):
+   # row slices of the frame, at least one so an empty selection still gets a header
+   for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+       yield start, df.iloc[start:start + EXPORT_CHUNK_ROWS]
+
+def write_csv(df, on_progress):
+   buffer = io.BytesIO()
+   for start, chunk in export_chunks(df):
+       buffer.write(chunk.to_csv(index=False, header=start == 0).encode())
+       on_progress(start + len(chunk))
+   return buffer.getvalue()
+
+def write_parquet(df, on_progress):
+   # one gzip-compressed row group per chunk
+   buffer = io.BytesIO()
+   writer = None
+   for start, chunk in export_chunks(df):
+       table = pa.Table.from_pandas(chunk, preserve_index=False)
+       if writer is None:
+           writer = pq.ParquetWriter(buffer, table.schema, compression='gzip')
+       writer.write_table(table)
+       on_progress(start + len(chunk))
+   writer.close()
+   return buffer.getvalue()
+
+# download format -> file extension, mime type, writer
+EXPORT_FORMATS = {
+   "CSV": ("csv", "text/csv", write_csv),
+   "Parquet": ("parquet", "application/vnd.apache.parquet", write_parquet)
+}
+
+def show_raw_data(filtered_df, selection):
+   # nothing here scales with the data until the user opens the table or asks for a file.
+   # `selection` identifies the filters and data version the prepared file was made from
+   st.subheader("Raw Data")
+   
+   if st.checkbox("Show raw data table"):
+       pages = max((len(filtered_df) - 1) // RAW_PAGE_ROWS + 1, 1)
+       page = st.number_input("Page", min_value=1, max_value=pages, value=1, step=1)
+       start = (page - 1) * RAW_PAGE_ROWS
+       st.dataframe(filtered_df.iloc[start:start + RAW_PAGE_ROWS], use_container_width=True)
+       st.caption(f"Rows {min(start + 1, len(filtered_df)):,}-{min(start + RAW_PAGE_ROWS, len(filtered_df)):,} of {len(filtered_df):,}, page {page} of {pages}")
+   
+   formats = [name for name in EXPORT_FORMATS if name != "Parquet" or pa is not None]
+   export_format = st.radio("Download format", formats, horizontal=True)
+   extension, mime, write = EXPORT_FORMATS[export_format]
+   
+   # the prepared file is kept for this session until the filters, format or data change
+   key = (export_format, selection)
+   prepared = st.session_state.get("raw_export")
+   if prepared is not None and prepared["key"] != key:
+       del st.session_state["raw_export"]
+       prepared = None
+   
+   if prepared is None:
+       if not st.button(f"Prepare {export_format} download ({len(filtered_df):,} rows)"):
+           return
+       progress = st.progress(0.0, text="Writing file...")
+       total = max(len(filtered_df), 1)
+       data = write(filtered_df, lambda rows: progress.progress(rows / total, text=f"Wrote {rows:,} of {len(filtered_df):,} rows"))
+       progress.empty()
+       prepared = {"key": key, "data": data, "file_name": f"energy_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"}
+       st.session_state["raw_export"] = prepared
+   
+   st.download_button(label=f"Download {export_format} ({len(prepared['data']) / 1e6:.1f} MB)", data=prepared["data"], file_name=prepared["file_name"], mime=mime)
 
 def main():
    st.title("Renewable Energy Analytics Dashboard")
    st.markdown("Real-time monitoring and analysis of energy generation & consumption")
    
+   force_refresh = st.sidebar.button("Check for new data")
+   
    # load data with spinner
    with st.spinner("Loading data..."):
-       df = load_data()
+       df, store = load_data(force_refresh)
    
    if df.empty:
        st.warning("No data available. Make sure the data pipeline is running")
        return
    
-   # clean up the data types
-   df['energy_generated_kwh'] = pd.to_numeric (df['energy_generated_kwh'], errors= 'coerce'). fillna(0)
-   df['energy_consumed_kwh'] = pd.to_numeric(df['energy_consumed_kwh'], errors='coerce').fillna(0)
-   df['net_energy_kwh'] =pd.to_numeric(df['net_energy_kwh'], errors= 'coerce').fillna(0)
-   df['timestamp'] =pd.to_datetime (df['timestamp'], errors='coerce')
-   df['anomaly'] = df['anomaly'].astype(bool)
-   
-   # remove rows with bad timestamps
-   df =df.dropna(subset=['timestamp'])
+   st.sidebar.caption(f"{len(df):,} readings, checked for new data at {datetime.fromtimestamp(store.checked_at).strftime('%H:%M:%S')}")
    
    # sidebar filters
    st.sidebar.header("Filters")
@@ -155,14 +416,8 @@ def main():
        st.subheader("Recent Anomalies")
        st.dataframe(anomalies[['site_id', 'timestamp', 'energy_generated_kwh', 'energy_consumed_kwh', 'net_energy_kwh']].head(10), use_container_width=True)
    
-   # show raw data in expandable section
-   with st.expander("Raw Data"):
-       st.dataframe(filtered_df,use_container_width=True)
-       
-       # download button for csv
-       csv = filtered_df.to_csv(index=False)
-       st.download_button(label="Download CSV", data=csv, 
-                         file_name=f" energy_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",  mime="text/csv")
+   # raw rows and downloads, loaded on demand
+   show_raw_data(filtered_df, (tuple(selected_sites), tuple(date_range), store.version))
 
 if __name__ == "__main__":
    main()
\ No newline at end of file